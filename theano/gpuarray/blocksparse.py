@@ -20,6 +20,10 @@ class GpuSparseBlockGemv(COp):
     GPU version of SparseBlockGemv. Check SparseBlockGemv's docstring for more
     information.
 
+    All the (batch, oWin, iWin) block products are done by a single batched
+    gemv that reads the blocks of W where they are and accumulates into the
+    output blocks, so W is never gathered.
+
     This should not be directly called since the interface is subject
     to change without notice.  Use the sandbox.blocksparse.sparse_block_dot()
     function for a stable interface.
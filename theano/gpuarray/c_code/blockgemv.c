@@ -32,6 +32,21 @@ int APPLY_SPECIFIC(blockgemv)(PyGpuArrayObject *o, PyGpuArrayObject *W,
     return -1;
   }
 
+  /* The batched gemv needs one of the two dimensions of the blocks of W to
+     be contiguous (as for W itself and for the transposed view used in the
+     grad), otherwise work on a copy of W. */
+  PyGpuArrayObject *W_copy = NULL;
+  size_t W_elsize = gpuarray_get_elsize(W->ga.typecode);
+  if (PyGpuArray_STRIDES(W)[2] != W_elsize &&
+      PyGpuArray_STRIDES(W)[3] != W_elsize) {
+    W_copy = pygpu_copy(W, GA_C_ORDER);
+    if (W_copy == NULL) {
+      // Error already set
+      return -1;
+    }
+    W = W_copy;
+  }
+
   /* Prepare lists for the batch */
   size_t maxi = PyGpuArray_DIMS(h)[1];
   size_t maxj = PyGpuArray_DIMS(out)[1];
@@ -58,6 +73,7 @@ int APPLY_SPECIFIC(blockgemv)(PyGpuArrayObject *o, PyGpuArrayObject *W,
     free(offInp);
     free(out_list);
     free(offOut);
+    Py_XDECREF(W_copy);
     PyErr_NoMemory();
     return -1;
   }
@@ -119,6 +135,7 @@ int APPLY_SPECIFIC(blockgemv)(PyGpuArrayObject *o, PyGpuArrayObject *W,
   free(offInp);
   free(out_list);
   free(offOut);
+  Py_XDECREF(W_copy);
   if (err != GA_NO_ERROR) {
     PyErr_SetString(PyExc_RuntimeError, "gemvBatch failed");
     return -1;
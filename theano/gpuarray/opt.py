@@ -27,7 +27,9 @@ from theano.scan_module import scan_utils, scan_op, scan_opt
 
 from theano.tensor.nnet import bn, conv3d2d
 from theano.tensor.nnet.conv import ConvOp
-from theano.tensor.nnet.blocksparse import SparseBlockGemv, SparseBlockOuter
+from theano.tensor.nnet.blocksparse import (SparseBlockGemv,
+                                            SparseBlockGemvBias,
+                                            SparseBlockOuter)
 from theano.tensor.nnet.abstract_conv import (BaseAbstractConv,
                                               AbstractConv2d,
                                               AbstractConv2d_gradWeights,
@@ -1503,12 +1505,30 @@ theano.tensor.nnet.conv2d()
 def local_gpua_sparseblockgemv(op, context_name, inputs, outputs):
     if inputs[0].dtype == 'float16':
         return
+    if op.weight_dtype is not None:
+        return
     if op.inplace:
         return gpu_sparse_block_gemv_inplace
     else:
         return gpu_sparse_block_gemv
 
 
+@register_opt('fast_compile')
+@op_lifter([SparseBlockGemvBias])
+@register_opt2([SparseBlockGemvBias], 'fast_compile')
+def local_gpua_sparseblockgemvbias(op, context_name, inputs, outputs):
+    # There is no fused kernel on the GPU, go back to take + gemv.
+    b, W, h, inputIdx, outputIdx = inputs
+    if b.dtype == 'float16':
+        return
+    with inherit_stack_trace(outputs):
+        b = as_gpuarray_variable(b, context_name)
+        o = GpuAdvancedSubtensor1()(b, outputIdx.flatten())
+        o = GpuReshape(3)(o, tensor.concatenate([outputIdx.shape,
+                                                 b.shape[1:]]))
+        return gpu_sparse_block_gemv(o, W, h, inputIdx, outputIdx)
+
+
 @register_opt('fast_compile')
 @op_lifter([SparseBlockOuter])
 @register_opt2([SparseBlockOuter], 'fast_compile')
@@ -23,6 +23,7 @@ class BlockSparse_Gemv_and_Outer(test_blocksparse.BlockSparse_Gemv_and_Outer):
         self.outer_op = gpu_sparse_block_outer
         self.gemv_class = GpuSparseBlockGemv
         self.outer_class = GpuSparseBlockOuter
+        self.dot_class = GpuSparseBlockGemv
 
     # This test is temporarily disabled since we disabled the output_merge
     # and alpha_merge optimizations for blocksparse due to brokeness.
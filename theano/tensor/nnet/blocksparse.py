@@ -1,13 +1,1231 @@
 from __future__ import absolute_import, print_function, division
+import os
+
 import numpy as np
 
 import theano
-from theano import Op, Apply
+from theano import Apply, config
+from theano.gof import OpenMPOp, utils
 from theano.tensor import discrete_dtypes
 from theano.gradient import grad_undefined
+from theano.misc.cpucount import cpuCount
+from theano.tensor import blas_headers
+from theano.tensor.blas import (have_fblas, _blas_gemv_fns, ldflags,
+                                blas_header_text, blas_header_version)
+
+# Whether the numba kernels can be used. None until they are first needed
+# (see `_numba_kernels`), False disables them.
+numba_available = None
+_kernels = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+
+def _default_n_threads():
+    """
+    Return the number of threads of OMP_NUM_THREADS (its first level if it
+    is a list like "4,2"), or the number of cores if it is unset or invalid.
+
+    """
+    try:
+        n = int(os.getenv('OMP_NUM_THREADS', '').split(',')[0])
+    except ValueError:
+        n = 0
+    return n if n > 0 else max(cpuCount(), 1)
+
+
+# Above this many elements, the NumPy gemv path doesn't gather all the blocks
+# of the call at once but calls BLAS once per output block.
+GATHER_MAX_SIZE = 2 ** 22
+# Number of threads the NumPy implementations split the batch over (NumPy
+# and BLAS release the GIL). 1 disables the thread pool. Only read when the
+# pool is created.
+N_THREADS = _default_n_threads()
+# Up to this iSize, the gemv kernel is generated for each block shape (see
+# `blocksparse_numba._specialized_gemv_kernel`). Like the other kernels,
+# they are compiled once per shape and dtype and cached on disk. 0 disables
+# them.
+SPECIALIZE_MAX_SIZE = 64
+
+_pool = None
+
+
+def _batch_map(fn, batch):
+    """
+    Call fn(b) for b in range(batch), split over a thread pool (created on
+    first use) when threads are available.
+
+    The calls must write disjoint parts of the outputs.
+
+    """
+    global _pool
+    n = min(N_THREADS, batch)
+    if ThreadPoolExecutor is None or n <= 1:
+        for b in range(batch):
+            fn(b)
+        return
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=N_THREADS)
+
+    def run(t):
+        for b in range(t, batch, n):
+            fn(b)
+    # list() waits for all the calls and raises the first error.
+    list(_pool.map(run, range(n)))
+
+
+def _numba_kernels():
+    """
+    Return the `blocksparse_numba` module, or None if numba is not
+    available (or disabled by setting numba_available to False).
+
+    """
+    global numba_available, _kernels
+    if numba_available is False:
+        return None
+    if _kernels is None:
+        try:
+            from theano.tensor.nnet import blocksparse_numba as _kernels
+        except ImportError:
+            numba_available = False
+            return None
+    numba_available = True
+    return _kernels
+
+
+def _gemv_kernel_for(iSize, oSize):
+    kernels = _numba_kernels()
+    if 0 < iSize <= SPECIALIZE_MAX_SIZE and oSize > 0:
+        return kernels._specialized_gemv_kernel(iSize, oSize)
+    return kernels._gemv_kernel
+
+
+def _use_numba(o):
+    return (o.dtype in ('float32', 'float64') and
+            _numba_kernels() is not None)
+
+
+def _block_indices(iIdx, oIdx, iBlocks, oBlocks,
+                   names=('inputIdx', 'outputIdx')):
+    """
+    Return iIdx and oIdx as intp arrays of indices in [0, iBlocks) and
+    [0, oBlocks) (negative indices count from the end).
+
+    Raise an IndexError if an index is out of bounds: the numba kernels
+    don't check their indices, and a flat block index
+    (`_flat_block_index`) would silently read another block.
+
+    """
+    res = []
+    for idx, n, name in zip((iIdx, oIdx), (iBlocks, oBlocks), names):
+        idx = np.asarray(idx, dtype=np.intp)
+        if idx.size and (idx.min() < -n or idx.max() >= n):
+            raise IndexError('%s out of bounds' % name)
+        res.append(np.where(idx < 0, idx + n, idx))
+    return res
+
+
+def _check_gemv_shapes(o, W, h, iIdx, oIdx, bias=None):
+    """
+    Raise a ValueError, like the C code, if the shapes of the gemv operands
+    don't match (the numba kernels would read or write out of bounds).
+
+    """
+    if iIdx.shape != h.shape[:2]:
+        raise ValueError('Shape mismatch between h and inputIdx')
+    if h.shape[2] != W.shape[2] or oIdx.shape[0] != h.shape[0]:
+        raise ValueError('Shape mismatch between h, W, inputIdx and '
+                         'outputIdx')
+    if bias is not None and bias.shape != (W.shape[1], W.shape[3]):
+        raise ValueError('Shape mismatch: bias.shape != W.shape[1::2]')
+    if oIdx.shape != o.shape[:2] or o.shape[2] != W.shape[3]:
+        raise ValueError('Shape mismatch between o, W and outputIdx')
+
+
+def _check_outer_shapes(o, x, y, xIdx, yIdx):
+    """
+    Raise a ValueError, like the C code, if the shapes of the outer product
+    operands don't match.
+
+    """
+    if (o.shape[2:] != (x.shape[2], y.shape[2]) or
+            xIdx.shape != x.shape[:2] or yIdx.shape != y.shape[:2] or
+            x.shape[0] != y.shape[0]):
+        raise ValueError('Shape mismatch between o, x, y, xIdx and yIdx')
+
+
+def bf16_pack(x):
+    """
+    Round a float32 array to bfloat16 (to nearest, ties to even).
+
+    Returns
+    -------
+    uint16 array
+        The bit patterns of the bfloat16 values, as expected for `W` by
+        ``SparseBlockGemv(weight_dtype='bfloat16')``.
+
+    """
+    x = np.ascontiguousarray(x, dtype='float32')
+    bits = x.view(np.uint32)
+    rounded = (bits + (np.uint32(0x7FFF) + ((bits >> 16) & 1))) >> 16
+    # Rounding could turn a NaN into an infinity, keep it a quiet NaN.
+    return np.where(np.isnan(x), (bits >> 16) | 0x40,
+                    rounded).astype(np.uint16)
+
+
+def bf16_unpack(x):
+    """
+    Convert bfloat16 bit patterns (as returned by `bf16_pack`) to float32.
+
+    """
+    return (np.asarray(x, dtype=np.uint32) << 16).view(np.float32)
+
+
+def int8_quantize(x):
+    """
+    Quantize an array to int8 with a single scale.
+
+    Returns
+    -------
+    (int8 array, float32 scalar)
+        x_i8 and scale such that x ~= scale * x_i8, as expected for `h` and
+        `h_scale` by `SparseBlockGemvInt8`.
+
+    """
+    x = np.asarray(x, dtype='float32')
+    scale = np.float32(np.abs(x).max() / 127.) if x.size else np.float32(0)
+    if scale == 0:
+        scale = np.float32(1)
+    return (np.clip(np.round(x / scale), -127, 127).astype(np.int8), scale)
+
+
+def int8_quantize_blocks(W):
+    """
+    Quantize a (iBlocks, oBlocks, iSize, oSize) weight tensor to int8 with
+    one scale per block.
+
+    Returns
+    -------
+    (int8 array, float32 array)
+        W_i8 and the (iBlocks, oBlocks) scales such that
+        W[i, j] ~= scales[i, j] * W_i8[i, j], as expected for `W` and
+        `scales` by `SparseBlockGemvInt8`.
+
+    """
+    W = np.asarray(W, dtype='float32')
+    scales = np.ones(W.shape[:2], dtype='float32')
+    if W.size:
+        scales = np.abs(W).max(axis=(2, 3)) / np.float32(127.)
+        scales[scales == 0] = 1
+    W_i8 = np.round(W / scales[:, :, None, None])
+    return (np.clip(W_i8, -127, 127).astype(np.int8),
+            scales.astype(np.float32))
+
+
+def _flat_block_index(iIdx, oIdx, oBlocks):
+    """
+    Return the (batch, iWin, oWin) linear index of the block
+    [iIdx[b, i], oIdx[b, j]] in a (iBlocks * oBlocks, ...) view.
+
+    The indices must be in bounds and non-negative (see `_block_indices`).
+
+    """
+    return (iIdx[:, :, None].astype(np.intp) * oBlocks +
+            oIdx[:, None, :])
+
+
+def _kernel_operands(W, iIdx, oIdx, nreads):
+    """
+    Prepare the operands of the gemv kernel.
+
+    The index arrays are returned as two separate contiguous intp arrays.
+    W is returned C-contiguous, so that the innermost loop of the kernel
+    has unit stride, when the `nreads` block reads of the call amortize
+    copying all of W (e.g. for the transposed view used in the grad).
+
+    """
+    if (not W.flags.c_contiguous and
+            nreads >= W.shape[0] * W.shape[1]):
+        W = np.ascontiguousarray(W)
+    return (W, np.ascontiguousarray(iIdx, dtype=np.intp),
+            np.ascontiguousarray(oIdx, dtype=np.intp))
+
+
+def _gather_blocks(W, iIdx, oIdx):
+    """
+    Return W[iIdx[b, i], oIdx[b, j]] as a C-contiguous
+    (batch, iWin, oWin, iSize, oSize) array.
+
+    """
+    iBlocks, oBlocks, iSize, oSize = W.shape
+    if W.flags.c_contiguous:
+        # A single take over contiguous blocks is much cheaper than a
+        # two-level fancy index.
+        Wflat = W.reshape(iBlocks * oBlocks, iSize, oSize)
+        return np.take(Wflat, _flat_block_index(iIdx, oIdx, oBlocks), axis=0)
+    # Don't copy all of W (e.g. the transposed view used in the grad) just
+    # to gather a few blocks.
+    return np.ascontiguousarray(W[iIdx[:, :, None], oIdx[:, None, :]])
+
+
+def _scatter_add_blocks(o, xIdx, yIdx, prods):
+    """
+    o[xIdx[b, i], yIdx[b, j]] += prods[b, i, j] for all (b, i, j), with
+    repeated pairs accumulated.
 
+    The products are sorted by destination block and each run of equal
+    blocks is summed with np.add.reduceat, so that every block of o is
+    written once (np.add.at does one slow unbuffered update per product).
 
-class SparseBlockGemv(Op):
+    """
+    xBlocks, yBlocks, xSize, ySize = o.shape
+    assert prods.shape[3:] == o.shape[2:]
+    xIdx, yIdx = _block_indices(xIdx, yIdx, xBlocks, yBlocks,
+                                ('xIdx', 'yIdx'))
+    keys = _flat_block_index(xIdx, yIdx, yBlocks).ravel()
+    if keys.size == 0:
+        return
+    order = np.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    sums = np.add.reduceat(prods.reshape(-1, xSize, ySize)[order], starts,
+                           axis=0)
+    keys = keys[starts]
+    if o.flags.c_contiguous:
+        o.reshape(xBlocks * yBlocks, xSize, ySize)[keys] += sums
+    else:
+        # The keys are distinct, so a buffered update is enough.
+        o[keys // yBlocks, keys % yBlocks] += sums
+
+
+def _n_unique_per_row(idx):
+    if idx.shape[1] == 0:
+        return np.zeros(idx.shape[0], dtype=np.intp)
+    srt = np.sort(idx, axis=1)
+    return 1 + (srt[:, 1:] != srt[:, :-1]).sum(axis=1)
+
+
+def _has_many_duplicates(iIdx, oIdx):
+    """
+    Tell if at most half of the (iIdx, oIdx) pairs of the windows are
+    distinct, in which case `_dedup_gemv` reads much less of W.
+
+    """
+    total = iIdx.shape[0] * iIdx.shape[1] * oIdx.shape[1]
+    if total == 0:
+        return False
+    distinct = (_n_unique_per_row(iIdx) * _n_unique_per_row(oIdx)).sum()
+    return 2 * distinct <= total
+
+
+def _dedup_gemv(o, W, h, iIdx, oIdx, bf16=False):
+    """
+    o += gemv(W, h, iIdx, oIdx), reading each distinct block once per
+    example.
+
+    The inputs that use the same block are summed first (the dot product is
+    linear in h) and the outputs that use the same block are computed once.
+
+    """
+    def row(b):
+        u_i, inv_i = np.unique(iIdx[b], return_inverse=True)
+        u_o, inv_o = np.unique(oIdx[b], return_inverse=True)
+        h_red = np.zeros((u_i.size, h.shape[2]), dtype=h.dtype)
+        np.add.at(h_red, inv_i, h[b])
+        blocks = W[u_i[:, None], u_o[None, :]]
+        if bf16:
+            blocks = bf16_unpack(blocks)
+        o[b] += np.einsum('is,ijso->jo', h_red, blocks)[inv_o]
+    _batch_map(row, o.shape[0])
+
+
+def _blas_gemv(o, W, h, iIdx, oIdx, bf16=False):
+    """
+    o += gemv(W, h, iIdx, oIdx) with one BLAS gemv per output block.
+
+    Only the iWin blocks of one output block are gathered at a time, as a
+    (iWin * iSize, oSize) matrix that multiplies the whole window of h.
+
+    This isn't split over the thread pool: the BLAS may already be
+    threaded, and the calls would oversubscribe the cores.
+
+    """
+    gemv = _blas_gemv_fns[o.dtype]
+    for b in range(o.shape[0]):
+        x = h[b].ravel()
+        for j in range(o.shape[1]):
+            blocks = W[iIdx[b], oIdx[b, j]]
+            if bf16:
+                blocks = bf16_unpack(blocks)
+            A = blocks.reshape(-1, blocks.shape[2])
+            # A.T is fortran-ordered, so scipy doesn't copy it.
+            o[b, j] = gemv(1.0, A.T, x, 1.0, o[b, j], overwrite_y=True)
+
+
+def _sparse_block_gemv(o, W, h, iIdx, oIdx, bf16=False, bias=None):
+    """
+    o += gemv(W, h, iIdx, oIdx), in place.
+
+    If `bias` is given, the initial content of o is ignored and
+    bias[oIdx[b, j]] is used instead.
+
+    """
+    _check_gemv_shapes(o, W, h, iIdx, oIdx, bias)
+    iIdx, oIdx = _block_indices(iIdx, oIdx, W.shape[0], W.shape[1])
+    if _use_numba(o):
+        W, iIdx, oIdx = _kernel_operands(
+            W, iIdx, oIdx, h.shape[0] * h.shape[1] * o.shape[1])
+        use_bias = bias is not None
+        if not use_bias:
+            bias = np.empty((0, o.shape[2]), dtype=o.dtype)
+        kernel = _gemv_kernel_for(W.shape[2], o.shape[2])
+        kernel(o, bias, W, h, iIdx, oIdx, use_bias, bf16)
+        return
+    if bias is not None:
+        np.take(bias, oIdx, axis=0, out=o)
+    if _has_many_duplicates(iIdx, oIdx):
+        _dedup_gemv(o, W, h, iIdx, oIdx, bf16)
+    elif (have_fblas and o.dtype in _blas_gemv_fns and
+          h.dtype == o.dtype and
+          (bf16 or W.dtype == o.dtype) and
+          iIdx.size * o.shape[1] * W.shape[2] * W.shape[3] >
+          GATHER_MAX_SIZE):
+        _blas_gemv(o, W, h, iIdx, oIdx, bf16)
+    else:
+        # Gather all the needed blocks once and contract them in one
+        # call instead of looping in Python.
+        Wg = _gather_blocks(W, iIdx, oIdx)
+        if bf16:
+            Wg = bf16_unpack(Wg)
+        o += np.einsum('bis,bijso->bjo', h, Wg, optimize=True)
+
+
+def _sparse_block_gemv_int8(o, W, scales, h, h_scale, iIdx, oIdx):
+    """
+    o += gemv(scales * W, h_scale * h, iIdx, oIdx) for int8 W and h, in
+    place.
+
+    The dot products of the blocks are accumulated in int32 and each one is
+    scaled once.
+
+    """
+    h = h.astype(np.int32)
+
+    def row(b):
+        blocks = W[iIdx[b][:, None], oIdx[b][None, :]].astype(np.int32)
+        acc = np.einsum('is,ijso->ijo', h[b], blocks)
+        sc = scales[iIdx[b][:, None], oIdx[b][None, :]] * h_scale
+        o[b] += np.einsum('ijo,ij->jo', acc, sc)
+    _batch_map(row, o.shape[0])
+
+
+# Vector kernel used by the C code instead of one BLAS call per block when
+# the blocks are small float32 blocks with contiguous rows. The instruction
+# set is the one Theano compiles for (it passes the -march flags of the
+# machine).
+sparse_block_simd_code = """
+#if defined(__AVX512F__)
+#include <immintrin.h>
+#define SPARSE_BLOCK_VLEN 16
+#define SPARSE_BLOCK_VEC __m512
+#define SPARSE_BLOCK_LOAD _mm512_loadu_ps
+#define SPARSE_BLOCK_STORE _mm512_storeu_ps
+#define SPARSE_BLOCK_SET1 _mm512_set1_ps
+#define SPARSE_BLOCK_FMADD _mm512_fmadd_ps
+#elif defined(__AVX2__) && defined(__FMA__)
+#include <immintrin.h>
+#define SPARSE_BLOCK_VLEN 8
+#define SPARSE_BLOCK_VEC __m256
+#define SPARSE_BLOCK_LOAD _mm256_loadu_ps
+#define SPARSE_BLOCK_STORE _mm256_storeu_ps
+#define SPARSE_BLOCK_SET1 _mm256_set1_ps
+#define SPARSE_BLOCK_FMADD _mm256_fmadd_ps
+#else
+#define SPARSE_BLOCK_VLEN 0
+#endif
+
+#if SPARSE_BLOCK_VLEN
+/* y[s] += sum_k x[k * incx] * w[k * ldw + s] for s < oSize, where oSize
+ * is a multiple of SPARSE_BLOCK_VLEN. Up to 4 vectors of y stay in
+ * registers during the whole k loop.
+ */
+static void sparse_block_fma_f32(const float* w, int ldw,
+                                 const float* x, int incx,
+                                 float* y, int iSize, int oSize)
+{
+    const int V = SPARSE_BLOCK_VLEN;
+    int s = 0;
+    for (; s + 4 * V <= oSize; s += 4 * V)
+    {
+        SPARSE_BLOCK_VEC a0 = SPARSE_BLOCK_LOAD(y + s);
+        SPARSE_BLOCK_VEC a1 = SPARSE_BLOCK_LOAD(y + s + V);
+        SPARSE_BLOCK_VEC a2 = SPARSE_BLOCK_LOAD(y + s + 2 * V);
+        SPARSE_BLOCK_VEC a3 = SPARSE_BLOCK_LOAD(y + s + 3 * V);
+        for (int k = 0; k < iSize; ++k)
+        {
+            SPARSE_BLOCK_VEC hk = SPARSE_BLOCK_SET1(x[(npy_intp)k * incx]);
+            const float* wk = w + (npy_intp)k * ldw + s;
+            a0 = SPARSE_BLOCK_FMADD(hk, SPARSE_BLOCK_LOAD(wk), a0);
+            a1 = SPARSE_BLOCK_FMADD(hk, SPARSE_BLOCK_LOAD(wk + V), a1);
+            a2 = SPARSE_BLOCK_FMADD(hk, SPARSE_BLOCK_LOAD(wk + 2 * V), a2);
+            a3 = SPARSE_BLOCK_FMADD(hk, SPARSE_BLOCK_LOAD(wk + 3 * V), a3);
+        }
+        SPARSE_BLOCK_STORE(y + s, a0);
+        SPARSE_BLOCK_STORE(y + s + V, a1);
+        SPARSE_BLOCK_STORE(y + s + 2 * V, a2);
+        SPARSE_BLOCK_STORE(y + s + 3 * V, a3);
+    }
+    for (; s < oSize; s += V)
+    {
+        SPARSE_BLOCK_VEC a = SPARSE_BLOCK_LOAD(y + s);
+        for (int k = 0; k < iSize; ++k)
+        {
+            a = SPARSE_BLOCK_FMADD(SPARSE_BLOCK_SET1(x[(npy_intp)k * incx]),
+                                   SPARSE_BLOCK_LOAD(w + (npy_intp)k * ldw + s),
+                                   a);
+        }
+        SPARSE_BLOCK_STORE(y + s, a);
+    }
+}
+#endif
+"""
+
+
+def _check_indices_c_code(iIdx, oIdx, fail, suffix=''):
+    """
+    C code checking that iIdx and oIdx index the iBlocks and oBlocks
+    blocks of W (negative indices count from the end).
+
+    `suffix` is appended to the names of the oWin, iBlocks and oBlocks
+    variables.
+
+    """
+    return """
+    // Check the indices here, the parallel loop can't fail.
+    for (npy_intp b = 0; b < batch; ++b)
+    {
+        for (npy_intp i = 0; i < iWin; ++i)
+        {
+            npy_intp k = *(dtype_%(iIdx)s*)PyArray_GETPTR2(%(iIdx)s, b, i);
+            if (k < -iBlocks%(suffix)s || k >= iBlocks%(suffix)s)
+            {
+                PyErr_SetString(PyExc_IndexError,
+                                "inputIdx out of bounds");
+                %(fail)s;
+            }
+        }
+        for (npy_intp j = 0; j < oWin%(suffix)s; ++j)
+        {
+            npy_intp k = *(dtype_%(oIdx)s*)PyArray_GETPTR2(%(oIdx)s, b, j);
+            if (k < -oBlocks%(suffix)s || k >= oBlocks%(suffix)s)
+            {
+                PyErr_SetString(PyExc_IndexError,
+                                "outputIdx out of bounds");
+                %(fail)s;
+            }
+        }
+    }
+    """ % locals()
+
+
+def _first_touch_copy_c_code(o, z, oWin, omp_parallel):
+    """
+    C code copying the (batch, oWin, oSize) o into the C-contiguous z.
+
+    The copy loop is split over the threads like the gemv loop, so a
+    freshly allocated z is first touched, and its pages placed on a NUMA
+    node, by the thread that then updates it (PyArray_CopyInto would put
+    all of it on the node of the calling thread).
+
+    """
+    return """
+        {
+            npy_intp cbatch = PyArray_DIMS(%(z)s)[0];
+            npy_intp cSize = PyArray_DIMS(%(z)s)[2];
+            %(omp_parallel)s
+            for (npy_intp bj = 0; bj < cbatch * %(oWin)s; ++bj)
+            {
+                npy_intp b = bj / %(oWin)s;
+                npy_intp j = bj %% %(oWin)s;
+                dtype_%(z)s* z_ptr = (dtype_%(z)s*)PyArray_GETPTR2(%(z)s,
+                                                                  b, j);
+                char* o_ptr = (char*)PyArray_GETPTR2(%(o)s, b, j);
+                for (npy_intp s = 0; s < cSize; ++s)
+                    z_ptr[s] = *(dtype_%(o)s*)(
+                        o_ptr + s * PyArray_STRIDES(%(o)s)[2]);
+            }
+        }
+    """ % locals()
+
+
+def sparse_block_gemv_c_code(o, W, h, iIdx, oIdx, z, fail, dtype,
+                             inplace=False, openmp=False, bias=None,
+                             blas_type=''):
+    """
+    z <- o + gemv(W, h, iIdx, oIdx), or bias[oIdx] + gemv(W, h, iIdx, oIdx)
+    if `bias` is given (then `o` is ignored).
+
+    See `sparse_block_gemv_multi_c_code`.
+
+    """
+    if bias is None:
+        return sparse_block_gemv_multi_c_code(
+            h, iIdx, [(o, W, oIdx, z)], fail, dtype, inplace, openmp,
+            blas_type=blas_type)
+    return sparse_block_gemv_multi_c_code(
+        h, iIdx, [(bias, W, oIdx, z)], fail, dtype, openmp=openmp,
+        bias=True, blas_type=blas_type)
+
+
+def sparse_block_gemv_multi_c_code(h, iIdx, heads, fail, dtype,
+                                   inplace=False, openmp=False, bias=False,
+                                   blas_type=''):
+    """
+    z <- o + gemv(W, h, iIdx, oIdx) for each (o, W, oIdx, z) in `heads`,
+    or z <- o[oIdx] + gemv(W, h, iIdx, oIdx) if `bias` (o is then a bias).
+    `bias` can also be a list with one flag per head.
+
+    The (batch, oWin) output blocks of all the heads are computed in one
+    parallel loop, the heads of an example one after the other so that its
+    h blocks stay in cache. Each output block is done with one BLAS gemv
+    call per input block, straight on the blocks of W (there is no gather).
+    For float32, blocks with contiguous rows and an oSize multiple of the
+    vector width use `sparse_block_simd_code` instead.
+
+    When z isn't o, each output block is initialized from o (or the bias)
+    in the same loop, so a freshly allocated z is first touched by the
+    thread that updates it (see `_first_touch_copy_c_code`).
+
+    `blas_type` is the BLAS used ('openblas', 'mkl' or ''), to run it on one
+    thread during the parallel loop, as in CorrMM.
+
+    """
+    gemv = {'float32': 'sgemv_', 'float64': 'dgemv_'}[dtype]
+    blas_set_num_threads = ''
+    blas_get_num_threads = '0'
+    if openmp:
+        omp_parallel = '#pragma omp parallel for schedule(static)'
+        if blas_type == 'openblas':
+            blas_set_num_threads = 'openblas_set_num_threads'
+            blas_get_num_threads = 'openblas_get_num_threads()'
+        elif blas_type == 'mkl':
+            blas_set_num_threads = 'mkl_set_num_threads'
+            blas_get_num_threads = 'mkl_get_max_threads()'
+    else:
+        omp_parallel = ''
+    simd = dtype == 'float32'
+    if isinstance(bias, (list, tuple)):
+        biases = [int(b) for b in bias]
+    else:
+        biases = [int(bias)] * len(heads)
+
+    # Everything is declared first: the failure label is in this scope and
+    # the goto can't cross initializations.
+    code = ["""
+    const int elemsize = sizeof(dtype_%(h)s);
+    npy_intp batch = PyArray_DIMS(%(h)s)[0];
+    npy_intp iWin = PyArray_DIMS(%(h)s)[1];
+    npy_intp iSize = PyArray_DIMS(%(h)s)[2];
+    npy_intp oWinTotal = 0;
+    char TRANS = 'T';
+    char NOTRANS = 'N';
+    dtype_%(h)s one = 1;
+    int Sh;
+    """ % locals()]
+    for k in range(len(heads)):
+        code.append("""
+    npy_intp oWin_%(k)d, iBlocks_%(k)d, oBlocks_%(k)d, oSize_%(k)d;
+    char* trans_%(k)d;
+    int M_%(k)d, N_%(k)d, LDA_%(k)d, Sz_%(k)d, use_simd_%(k)d, copy_%(k)d;
+    """ % locals())
+    code.append("""
+    if (PyArray_DIMS(%(iIdx)s)[0] != batch
+        || PyArray_DIMS(%(iIdx)s)[1] != iWin)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "Shape mismatch between h and inputIdx");
+        %(fail)s;
+    }
+    if (iSize > 1
+        && (PyArray_STRIDES(%(h)s)[2] <= 0
+            || PyArray_STRIDES(%(h)s)[2] %% elemsize != 0))
+    {
+        PyArrayObject * h_copy = (PyArrayObject *) PyArray_NewCopy(
+            %(h)s, NPY_CORDER);
+        if (!h_copy)
+            %(fail)s
+        Py_XDECREF(%(h)s);
+        %(h)s = h_copy;
+    }
+    Sh = (iSize > 1) ? PyArray_STRIDES(%(h)s)[2] / elemsize : 1;
+    """ % locals())
+
+    for k, (o, W, oIdx, z) in enumerate(heads):
+        has_bias = biases[k]
+        check_indices = _check_indices_c_code(iIdx, oIdx, fail,
+                                              '_%d' % k)
+        code.append("""
+    oWin_%(k)d = PyArray_DIMS(%(oIdx)s)[1];
+    iBlocks_%(k)d = PyArray_DIMS(%(W)s)[0];
+    oBlocks_%(k)d = PyArray_DIMS(%(W)s)[1];
+    oSize_%(k)d = PyArray_DIMS(%(W)s)[3];
+    if (PyArray_DIMS(%(W)s)[2] != iSize
+        || PyArray_DIMS(%(oIdx)s)[0] != batch)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "Shape mismatch between h, W, inputIdx and outputIdx");
+        %(fail)s;
+    }
+    if (%(has_bias)d)
+    {
+        if (PyArray_DIMS(%(o)s)[0] != oBlocks_%(k)d
+            || PyArray_DIMS(%(o)s)[1] != oSize_%(k)d)
+        {
+            PyErr_SetString(PyExc_ValueError,
+                            "Shape mismatch: bias.shape != W.shape[1::2]");
+            %(fail)s;
+        }
+    }
+    else if (PyArray_DIMS(%(o)s)[0] != batch
+             || PyArray_DIMS(%(o)s)[1] != oWin_%(k)d
+             || PyArray_DIMS(%(o)s)[2] != oSize_%(k)d)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "Shape mismatch between o, W and outputIdx");
+        %(fail)s;
+    }
+
+    %(check_indices)s
+
+    // The blocks of W are given to gemv as they are if one of their
+    // dimensions is contiguous (W itself, or the transposed view used in
+    // the grad), otherwise we copy W.
+    {
+        npy_intp sW2 = PyArray_STRIDES(%(W)s)[2];
+        npy_intp sW3 = PyArray_STRIDES(%(W)s)[3];
+        if (sW3 == elemsize
+            && (iSize <= 1 || (sW2 > 0 && sW2 %% elemsize == 0
+                               && sW2 / elemsize >= oSize_%(k)d)))
+        {
+            trans_%(k)d = &NOTRANS;
+        }
+        else if (sW2 == elemsize
+                 && (oSize_%(k)d <= 1 || (sW3 > 0 && sW3 %% elemsize == 0
+                                          && sW3 / elemsize >= iSize)))
+        {
+            trans_%(k)d = &TRANS;
+        }
+        else
+        {
+            PyArrayObject * W_copy = (PyArrayObject *) PyArray_NewCopy(
+                %(W)s, NPY_CORDER);
+            if (!W_copy)
+                %(fail)s
+            Py_XDECREF(%(W)s);
+            %(W)s = W_copy;
+            trans_%(k)d = &NOTRANS;
+        }
+    }
+
+    copy_%(k)d = 0;
+    if (%(has_bias)d || !%(inplace)d
+        || (oSize_%(k)d > 1
+            && (PyArray_STRIDES(%(o)s)[2] <= 0
+                || PyArray_STRIDES(%(o)s)[2] %% elemsize != 0)))
+    {
+        npy_intp dims[3];
+        dims[0] = batch;
+        dims[1] = oWin_%(k)d;
+        dims[2] = oSize_%(k)d;
+        if ((NULL == %(z)s) || (%(z)s == %(o)s)
+            || !PyArray_IS_C_CONTIGUOUS(%(z)s)
+            || (PyArray_DIMS(%(z)s)[0] != dims[0])
+            || (PyArray_DIMS(%(z)s)[1] != dims[1])
+            || (PyArray_DIMS(%(z)s)[2] != dims[2]))
+        {
+            Py_XDECREF(%(z)s);
+            %(z)s = (PyArrayObject*)PyArray_SimpleNew(3, dims,
+                                                      PyArray_TYPE(%(o)s));
+            if (!%(z)s)
+            {
+                PyErr_SetString(PyExc_MemoryError,
+                                "failed to alloc sparse_block_gemv output");
+                %(fail)s
+            }
+        }
+        copy_%(k)d = !%(has_bias)d;
+    }
+    else if (%(z)s != %(o)s)
+    {
+        Py_XDECREF(%(z)s);
+        %(z)s = %(o)s;
+        Py_INCREF(%(z)s);
+    }
+
+    /* BLAS wants the leading dimension to be at least the number of
+     * rows, even when there is a single column.
+     */
+    if (trans_%(k)d == &NOTRANS)
+    {
+        M_%(k)d = oSize_%(k)d;
+        N_%(k)d = iSize;
+        LDA_%(k)d = (iSize > 1) ? PyArray_STRIDES(%(W)s)[2] / elemsize
+                                : oSize_%(k)d;
+    }
+    else
+    {
+        M_%(k)d = iSize;
+        N_%(k)d = oSize_%(k)d;
+        LDA_%(k)d = (oSize_%(k)d > 1) ? PyArray_STRIDES(%(W)s)[3] / elemsize
+                                      : iSize;
+    }
+    if (LDA_%(k)d < 1)
+        LDA_%(k)d = 1;
+    Sz_%(k)d = (oSize_%(k)d > 1) ? PyArray_STRIDES(%(z)s)[2] / elemsize : 1;
+    use_simd_%(k)d = 0;
+    #if SPARSE_BLOCK_VLEN
+    use_simd_%(k)d = (%(simd)d && trans_%(k)d == &NOTRANS && Sz_%(k)d == 1
+                      && oSize_%(k)d %% SPARSE_BLOCK_VLEN == 0);
+    #endif
+    oWinTotal += oWin_%(k)d;
+    """ % locals())
+
+    code.append("""
+    {
+        int blas_threads_saved = %(blas_get_num_threads)s;
+        // The gemv calls are already parallel.
+        %(blas_set_num_threads)s(1);
+        %(omp_parallel)s
+        for (npy_intp bj = 0; bj < batch * oWinTotal; ++bj)
+        {
+            npy_intp b = bj / oWinTotal;
+            // Index of the output block in the concatenation of the heads.
+            npy_intp j = bj %% oWinTotal;
+    """ % locals())
+    for k, (o, W, oIdx, z) in enumerate(heads):
+        has_bias = biases[k]
+        code.append("""
+            if (j >= 0 && j < oWin_%(k)d)
+            {
+                npy_intp ok = *(dtype_%(oIdx)s*)PyArray_GETPTR2(%(oIdx)s,
+                                                                b, j);
+                char* z_ptr = (char*)PyArray_GETPTR2(%(z)s, b, j);
+                if (ok < 0)
+                    ok += oBlocks_%(k)d;
+                if (%(has_bias)d)
+                {
+                    for (npy_intp s = 0; s < oSize_%(k)d; ++s)
+                    {
+                        *(dtype_%(z)s*)(z_ptr +
+                                        s * PyArray_STRIDES(%(z)s)[2]) =
+                            *(dtype_%(z)s*)PyArray_GETPTR2(%(o)s, ok, s);
+                    }
+                }
+                else if (copy_%(k)d)
+                {
+                    char* o_ptr = (char*)PyArray_GETPTR2(%(o)s, b, j);
+                    for (npy_intp s = 0; s < oSize_%(k)d; ++s)
+                    {
+                        *(dtype_%(z)s*)(z_ptr +
+                                        s * PyArray_STRIDES(%(z)s)[2]) =
+                            *(dtype_%(o)s*)(o_ptr +
+                                            s * PyArray_STRIDES(%(o)s)[2]);
+                    }
+                }
+                for (npy_intp i = 0;
+                     iSize > 0 && oSize_%(k)d > 0 && i < iWin; ++i)
+                {
+                    npy_intp ik = *(dtype_%(iIdx)s*)PyArray_GETPTR2(
+                        %(iIdx)s, b, i);
+                    if (ik < 0)
+                        ik += iBlocks_%(k)d;
+    #if SPARSE_BLOCK_VLEN
+                    if (use_simd_%(k)d)
+                    {
+                        sparse_block_fma_f32(
+                            (float*)PyArray_GETPTR2(%(W)s, ik, ok),
+                            LDA_%(k)d,
+                            (float*)PyArray_GETPTR2(%(h)s, b, i), Sh,
+                            (float*)z_ptr, iSize, oSize_%(k)d);
+                        continue;
+                    }
+    #endif
+                    %(gemv)s(trans_%(k)d, &M_%(k)d, &N_%(k)d, &one,
+                             (dtype_%(z)s*)PyArray_GETPTR2(%(W)s, ik, ok),
+                             &LDA_%(k)d,
+                             (dtype_%(z)s*)PyArray_GETPTR2(%(h)s, b, i),
+                             &Sh, &one, (dtype_%(z)s*)z_ptr, &Sz_%(k)d);
+                }
+            }
+            j -= oWin_%(k)d;
+    """ % locals())
+    code.append("""
+        }
+        %(blas_set_num_threads)s(blas_threads_saved);
+    }
+    """ % locals())
+    return ''.join(code)
+
+
+class BaseSparseBlockGemv(OpenMPOp):
+    """
+    Base class for the C implementation of `SparseBlockGemv` and
+    `SparseBlockGemvBias`.
+
+    The C code is only used for float32 and float64 with a real BLAS (it
+    calls BLAS from several threads). Otherwise these ops run `perform`.
+
+    """
+    @property
+    def blas_type(self):
+        # Same detection as CorrMM, to set the number of BLAS threads.
+        if 'openblas' in config.blas.ldflags:
+            return 'openblas'
+        elif 'mkl' in config.blas.ldflags:
+            return 'mkl'
+        return ''
+
+    def c_support_code(self):
+        ccodes = blas_header_text()
+        if self.blas_type == 'openblas':
+            ccodes += blas_headers.openblas_threads_text()
+        elif self.blas_type == 'mkl':
+            ccodes += blas_headers.mkl_threads_text()
+        return ccodes + sparse_block_simd_code
+
+    def c_libraries(self):
+        return ldflags()
+
+    def c_compile_args(self):
+        compile_args = ldflags(libs=False, flags=True)
+        compile_args += super(BaseSparseBlockGemv, self).c_compile_args()
+        return compile_args
+
+    def c_lib_dirs(self):
+        return ldflags(libs=False, libs_dir=True)
+
+    def c_header_dirs(self):
+        return ldflags(libs=False, include_dir=True)
+
+    def c_code_cache_version(self):
+        return (6, self.openmp, self.blas_type, blas_header_version())
+
+    def _check_c_code(self, node, variables):
+        dtype = node.outputs[0].dtype
+        if (not config.blas.ldflags or
+                getattr(self, 'weight_dtype', None) is not None or
+                dtype not in ('float32', 'float64') or
+                any(v.dtype != dtype for v in variables)):
+            raise utils.MethodNotDefined('%s.c_code'
+                                         % self.__class__.__name__)
+        return dtype
+
+
+# Block dot product of SparseBlockGemvInt8. With AVX512-VNNI, 4 rows of the
+# block are interleaved so that each 32 bit lane holds 4 consecutive int8
+# weights of an output, and one vpdpbusd does 64 multiply-adds. vpdpbusd
+# multiplies unsigned by signed bytes, so h is offset by 128 and the
+# 128 * sum(w) this adds is computed (with vpdpbusd too) and removed.
+sparse_block_int8_code = """
+#if defined(__AVX512F__) && defined(__AVX512VNNI__)
+#include <immintrin.h>
+#endif
+
+/* acc[s] = sum_k x[k * sx] * w[k * sw2 + s * sw3] for int8 x and w. */
+static void sparse_block_dot_i8(const npy_int8* w, npy_intp sw2,
+                                npy_intp sw3, const npy_int8* x,
+                                npy_intp sx, npy_int32* acc,
+                                int iSize, int oSize)
+{
+#if defined(__AVX512F__) && defined(__AVX512VNNI__)
+    if (sw3 == 1 && sx == 1 && iSize % 4 == 0 && oSize % 16 == 0)
+    {
+        const __m512i offset = _mm512_set1_epi8((char)0x80);
+        for (int s = 0; s < oSize; s += 16)
+        {
+            __m512i a = _mm512_setzero_si512();
+            __m512i c = _mm512_setzero_si512();
+            for (int k = 0; k < iSize; k += 4)
+            {
+                const npy_int8* wk = w + k * sw2 + s;
+                __m128i r0 = _mm_loadu_si128((const __m128i*)wk);
+                __m128i r1 = _mm_loadu_si128((const __m128i*)(wk + sw2));
+                __m128i r2 = _mm_loadu_si128((const __m128i*)(wk + 2 * sw2));
+                __m128i r3 = _mm_loadu_si128((const __m128i*)(wk + 3 * sw2));
+                __m128i l01 = _mm_unpacklo_epi8(r0, r1);
+                __m128i h01 = _mm_unpackhi_epi8(r0, r1);
+                __m128i l23 = _mm_unpacklo_epi8(r2, r3);
+                __m128i h23 = _mm_unpackhi_epi8(r2, r3);
+                __m512i wp = _mm512_castsi128_si512(
+                    _mm_unpacklo_epi16(l01, l23));
+                wp = _mm512_inserti32x4(wp, _mm_unpackhi_epi16(l01, l23), 1);
+                wp = _mm512_inserti32x4(wp, _mm_unpacklo_epi16(h01, h23), 2);
+                wp = _mm512_inserti32x4(wp, _mm_unpackhi_epi16(h01, h23), 3);
+                int x4;
+                memcpy(&x4, x + k, 4);
+                __m512i xk = _mm512_xor_si512(_mm512_set1_epi32(x4), offset);
+                a = _mm512_dpbusd_epi32(a, xk, wp);
+                c = _mm512_dpbusd_epi32(c, offset, wp);
+            }
+            _mm512_storeu_si512(acc + s, _mm512_sub_epi32(a, c));
+        }
+        return;
+    }
+#endif
+    for (int s = 0; s < oSize; ++s)
+        acc[s] = 0;
+    for (int k = 0; k < iSize; ++k)
+    {
+        npy_int32 xk = x[k * sx];
+        const npy_int8* wk = w + k * sw2;
+        for (int s = 0; s < oSize; ++s)
+            acc[s] += xk * wk[s * sw3];
+    }
+}
+"""
+
+
+def sparse_block_gemv_int8_c_code(o, W, scales, h, h_scale, iIdx, oIdx, z,
+                                  fail, inplace=False, openmp=False):
+    """
+    z <- o + gemv(scales * W, h_scale * h, iIdx, oIdx) for float32 o and
+    int8 W and h.
+
+    """
+    if openmp:
+        omp_parallel = '#pragma omp parallel for schedule(static)'
+        omp_get_max_threads = 'omp_get_max_threads()'
+        omp_get_thread_num = 'omp_get_thread_num()'
+    else:
+        omp_parallel = ''
+        omp_get_max_threads = '1'
+        omp_get_thread_num = '0'
+    code = """
+    npy_intp batch = PyArray_DIMS(%(oIdx)s)[0];
+    npy_intp oWin = PyArray_DIMS(%(oIdx)s)[1];
+    npy_intp iWin = PyArray_DIMS(%(iIdx)s)[1];
+    npy_intp iBlocks = PyArray_DIMS(%(W)s)[0];
+    npy_intp oBlocks = PyArray_DIMS(%(W)s)[1];
+    npy_intp iSize = PyArray_DIMS(%(W)s)[2];
+    npy_intp oSize = PyArray_DIMS(%(W)s)[3];
+    float hs = ((dtype_%(h_scale)s*)PyArray_DATA(%(h_scale)s))[0];
+    int nthreads = %(omp_get_max_threads)s;
+    npy_int32* acc_buf;
+
+    if (PyArray_DIMS(%(h)s)[0] != batch
+        || PyArray_DIMS(%(iIdx)s)[0] != batch
+        || PyArray_DIMS(%(h)s)[1] != iWin
+        || PyArray_DIMS(%(h)s)[2] != iSize
+        || PyArray_DIMS(%(o)s)[0] != batch
+        || PyArray_DIMS(%(o)s)[1] != oWin
+        || PyArray_DIMS(%(o)s)[2] != oSize
+        || PyArray_DIMS(%(scales)s)[0] != iBlocks
+        || PyArray_DIMS(%(scales)s)[1] != oBlocks)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "Shape mismatch between o, W, scales, h, "
+                        "inputIdx and outputIdx");
+        %(fail)s;
+    }
+
+    %(check_indices)s
+
+    if (!%(inplace)d || !PyArray_IS_C_CONTIGUOUS(%(o)s))
+    {
+        if ((NULL == %(z)s) || (%(z)s == %(o)s)
+            || !PyArray_IS_C_CONTIGUOUS(%(z)s)
+            || (PyArray_DIMS(%(z)s)[0] != batch)
+            || (PyArray_DIMS(%(z)s)[1] != oWin)
+            || (PyArray_DIMS(%(z)s)[2] != oSize))
+        {
+            Py_XDECREF(%(z)s);
+            %(z)s = (PyArrayObject*)PyArray_SimpleNew(3, PyArray_DIMS(%(o)s),
+                                                      PyArray_TYPE(%(o)s));
+            if (!%(z)s)
+            {
+                PyErr_SetString(PyExc_MemoryError,
+                                "failed to alloc sparse_block_gemv output");
+                %(fail)s
+            }
+        }
+        %(copy)s
+    }
+    else if (%(z)s != %(o)s)
+    {
+        Py_XDECREF(%(z)s);
+        %(z)s = %(o)s;
+        Py_INCREF(%(z)s);
+    }
+
+    acc_buf = (npy_int32*)malloc(nthreads * (oSize + 1) * sizeof(npy_int32));
+    if (!acc_buf)
+    {
+        PyErr_NoMemory();
+        %(fail)s
+    }
+    %(omp_parallel)s
+    for (npy_intp bj = 0; bj < batch * oWin; ++bj)
+    {
+        npy_intp b = bj / oWin;
+        npy_intp j = bj %% oWin;
+        npy_int32* acc = acc_buf + %(omp_get_thread_num)s * (oSize + 1);
+        npy_intp ok = *(dtype_%(oIdx)s*)PyArray_GETPTR2(%(oIdx)s, b, j);
+        dtype_%(z)s* z_ptr = (dtype_%(z)s*)PyArray_GETPTR2(%(z)s, b, j);
+        if (ok < 0)
+            ok += oBlocks;
+        for (npy_intp i = 0; i < iWin; ++i)
+        {
+            npy_intp ik = *(dtype_%(iIdx)s*)PyArray_GETPTR2(%(iIdx)s, b, i);
+            if (ik < 0)
+                ik += iBlocks;
+            sparse_block_dot_i8(
+                (npy_int8*)PyArray_GETPTR2(%(W)s, ik, ok),
+                PyArray_STRIDES(%(W)s)[2], PyArray_STRIDES(%(W)s)[3],
+                (npy_int8*)PyArray_GETPTR2(%(h)s, b, i),
+                PyArray_STRIDES(%(h)s)[2], acc, iSize, oSize);
+            float sc = hs * *(dtype_%(scales)s*)PyArray_GETPTR2(%(scales)s,
+                                                                 ik, ok);
+            for (npy_intp s = 0; s < oSize; ++s)
+                z_ptr[s] += sc * acc[s];
+        }
+    }
+    free(acc_buf);
+    """
+    return code % dict(locals(), inplace=inplace,
+                       check_indices=_check_indices_c_code(iIdx, oIdx, fail),
+                       copy=_first_touch_copy_c_code(o, z, 'oWin',
+                                                     omp_parallel))
+
+
+def sparse_block_outer_c_code(o, x, y, xIdx, yIdx, alpha, z, fail,
+                              inplace=False, openmp=False):
+    """
+    z <- o + alpha * outer(x, y, xIdx, yIdx).
+
+    Different examples can update the same block of z, so the work is
+    split over the rows of the blocks: each thread updates row k of all
+    the blocks, and every row update is a contiguous axpy when the rows of
+    z and y are.
+
+    """
+    if openmp:
+        omp_parallel = '#pragma omp parallel for schedule(static)'
+    else:
+        omp_parallel = ''
+    # x plays the role of the input and y the one of the output here.
+    check_indices = _check_indices_c_code(xIdx, yIdx, fail)
+    return """
+    npy_intp batch = PyArray_DIMS(%(x)s)[0];
+    npy_intp iWin = PyArray_DIMS(%(x)s)[1];
+    npy_intp xSize = PyArray_DIMS(%(x)s)[2];
+    npy_intp oWin = PyArray_DIMS(%(y)s)[1];
+    npy_intp ySize = PyArray_DIMS(%(y)s)[2];
+    npy_intp iBlocks = PyArray_DIMS(%(o)s)[0];
+    npy_intp oBlocks = PyArray_DIMS(%(o)s)[1];
+    dtype_%(z)s a = ((dtype_%(alpha)s*)PyArray_DATA(%(alpha)s))[0];
+    const int elemsize = sizeof(dtype_%(z)s);
+
+    if (PyArray_DIMS(%(y)s)[0] != batch
+        || PyArray_DIMS(%(xIdx)s)[0] != batch
+        || PyArray_DIMS(%(xIdx)s)[1] != iWin
+        || PyArray_DIMS(%(yIdx)s)[0] != batch
+        || PyArray_DIMS(%(yIdx)s)[1] != oWin
+        || PyArray_DIMS(%(o)s)[2] != xSize
+        || PyArray_DIMS(%(o)s)[3] != ySize)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "Shape mismatch between o, x, y, xIdx and yIdx");
+        %(fail)s;
+    }
+
+    %(check_indices)s
+
+    if (!%(inplace)d)
+    {
+        if ((NULL == %(z)s) || (%(z)s == %(o)s)
+            || !PyArray_IS_C_CONTIGUOUS(%(z)s)
+            || (PyArray_DIMS(%(z)s)[0] != iBlocks)
+            || (PyArray_DIMS(%(z)s)[1] != oBlocks)
+            || (PyArray_DIMS(%(z)s)[2] != xSize)
+            || (PyArray_DIMS(%(z)s)[3] != ySize))
+        {
+            Py_XDECREF(%(z)s);
+            %(z)s = (PyArrayObject*)PyArray_SimpleNew(4, PyArray_DIMS(%(o)s),
+                                                      PyArray_TYPE(%(o)s));
+            if (!%(z)s)
+            {
+                PyErr_SetString(PyExc_MemoryError,
+                                "failed to alloc sparse_block_outer output");
+                %(fail)s
+            }
+        }
+        if (PyArray_CopyInto(%(z)s, %(o)s) != 0)
+            %(fail)s
+    }
+    else if (%(z)s != %(o)s)
+    {
+        Py_XDECREF(%(z)s);
+        %(z)s = %(o)s;
+        Py_INCREF(%(z)s);
+    }
+
+    {
+        npy_intp zs0 = PyArray_STRIDES(%(z)s)[0];
+        npy_intp zs1 = PyArray_STRIDES(%(z)s)[1];
+        npy_intp zs2 = PyArray_STRIDES(%(z)s)[2];
+        npy_intp zs3 = PyArray_STRIDES(%(z)s)[3];
+        npy_intp ys2 = PyArray_STRIDES(%(y)s)[2];
+        int contiguous = (ySize <= 1 || (zs3 == elemsize && ys2 == elemsize));
+
+        %(omp_parallel)s
+        for (npy_intp k = 0; k < xSize; ++k)
+        {
+            for (npy_intp b = 0; b < batch; ++b)
+            {
+                for (npy_intp i = 0; i < iWin; ++i)
+                {
+                    npy_intp xk = *(dtype_%(xIdx)s*)PyArray_GETPTR2(
+                        %(xIdx)s, b, i);
+                    dtype_%(z)s xv = a * *(dtype_%(x)s*)PyArray_GETPTR3(
+                        %(x)s, b, i, k);
+                    char* z_row;
+                    if (xk < 0)
+                        xk += iBlocks;
+                    z_row = PyArray_BYTES(%(z)s) + xk * zs0 + k * zs2;
+                    for (npy_intp j = 0; j < oWin; ++j)
+                    {
+                        npy_intp yk = *(dtype_%(yIdx)s*)PyArray_GETPTR2(
+                            %(yIdx)s, b, j);
+                        char* zp;
+                        char* yp = (char*)PyArray_GETPTR2(%(y)s, b, j);
+                        if (yk < 0)
+                            yk += oBlocks;
+                        zp = z_row + yk * zs1;
+                        if (contiguous)
+                        {
+                            dtype_%(z)s* zr = (dtype_%(z)s*)zp;
+                            const dtype_%(y)s* yr = (dtype_%(y)s*)yp;
+                            for (npy_intp s = 0; s < ySize; ++s)
+                                zr[s] += xv * yr[s];
+                        }
+                        else
+                        {
+                            for (npy_intp s = 0; s < ySize; ++s)
+                                *(dtype_%(z)s*)(zp + s * zs3) +=
+                                    xv * *(dtype_%(y)s*)(yp + s * ys2);
+                        }
+                    }
+                }
+            }
+        }
+    }
+    """ % locals()
+
+
+class SparseBlockGemv(BaseSparseBlockGemv):
     """
     This op computes the dot product of specified pieces of vectors
     and matrices, returning pieces of vectors::
@@ -19,18 +1237,30 @@ class SparseBlockGemv(Op):
 
     where b, h, W, o iIdx, oIdx are defined in the docstring of make_node.
 
+    With ``weight_dtype='bfloat16'``, W holds the uint16 bit patterns of
+    bfloat16 weights (see `bf16_pack`). They are widened to float32 as they
+    are read and the accumulation is done in the dtype of o, so only the
+    storage (and the memory traffic) of W is halved. bfloat16 keeps about 3
+    significant digits, so expect results to differ from the float32
+    computation by about 1e-2 relative.
+
     .. image:: ../../../images/blocksparse.png
         :scale: 50 %
 
     """
-    __props__ = ('inplace',)
+    __props__ = ('inplace', 'weight_dtype')
 
     registered_opts = []
 
-    def __init__(self, inplace=False):
+    def __init__(self, inplace=False, weight_dtype=None, openmp=None):
+        super(SparseBlockGemv, self).__init__(openmp=openmp)
         self.inplace = inplace
         if self.inplace:
             self.destroy_map = {0: [0]}
+        if weight_dtype not in (None, 'bfloat16'):
+            raise ValueError("weight_dtype must be None or 'bfloat16'",
+                             weight_dtype)
+        self.weight_dtype = weight_dtype
 
     def make_node(self, o, W, h, inputIdx, outputIdx):
         """
@@ -88,6 +1318,9 @@ class SparseBlockGemv(Op):
             raise TypeError('The input indices inputIdx must be a 2D tensor')
         if outputIdx.ndim != 2:
             raise TypeError('The output indices outputIdx must be a 2D tensor')
+        if self.weight_dtype == 'bfloat16' and W.dtype != 'uint16':
+            raise TypeError('bfloat16 weights must be given as their uint16 '
+                            'bit patterns', W.dtype)
 
         assert inputIdx.type.dtype in discrete_dtypes
         assert outputIdx.type.dtype in discrete_dtypes
@@ -100,15 +1333,18 @@ class SparseBlockGemv(Op):
         if not self.inplace:
             o = o.copy()
 
-        for b in range(o.shape[0]):
-            for j in range(o.shape[1]):
-                outputIdx = oIdx[b, j]
-                for i in range(h.shape[1]):
-                    inputIdx = iIdx[b, i]
-                    w = W[inputIdx, outputIdx]
-                    o[b, j, :] += np.dot(h[b, i], w)
+        _sparse_block_gemv(o, W, h, iIdx, oIdx,
+                           bf16=self.weight_dtype == 'bfloat16')
         out_[0][0] = o
 
+    def c_code(self, node, name, inp, out, sub):
+        dtype = self._check_c_code(node, node.inputs[:3])
+        o, W, h, iIdx, oIdx = inp
+        z, = out
+        return sparse_block_gemv_c_code(o, W, h, iIdx, oIdx, z, sub['fail'],
+                                        dtype, self.inplace, self.openmp,
+                                        blas_type=self.blas_type)
+
     def infer_shape(self, node, input_shapes):
         return [input_shapes[0]]
 
@@ -117,9 +1353,13 @@ class SparseBlockGemv(Op):
         go = grads[0]
 
         outer_fun = SparseBlockOuter(self.inplace)
-        gemv_fun = SparseBlockGemv(self.inplace)
+        gemv_fun = SparseBlockGemv(self.inplace, self.weight_dtype)
 
-        Wgrad = outer_fun(W.zeros_like(), h, go, inputIdx, outputIdx)
+        if self.weight_dtype == 'bfloat16':
+            Wgrad = grad_undefined(self, 1, W,
+                                   "W holds bfloat16 bit patterns")
+        else:
+            Wgrad = outer_fun(W.zeros_like(), h, go, inputIdx, outputIdx)
         hgrad = gemv_fun(h.zeros_like(), W.dimshuffle((1, 0, 3, 2)),
                          go, outputIdx, inputIdx)
         return [go, Wgrad, hgrad,
@@ -129,7 +1369,7 @@ class SparseBlockGemv(Op):
                                "grad of outputIdx makes no sense")]
 
 
-class SparseBlockOuter(Op):
+class SparseBlockOuter(OpenMPOp):
     """
     This computes the outer product of two sets of pieces of vectors
     updating a full matrix with the results::
@@ -144,7 +1384,8 @@ class SparseBlockOuter(Op):
 
     registered_opts = []
 
-    def __init__(self, inplace=False):
+    def __init__(self, inplace=False, openmp=None):
+        super(SparseBlockOuter, self).__init__(openmp=openmp)
         self.inplace = inplace
         if self.inplace:
             self.destroy_map = {0: [0]}
@@ -202,24 +1443,389 @@ class SparseBlockOuter(Op):
     def perform(self, node, inp, out_):
         o, x, y, xIdx, yIdx, alpha = inp[:6]
 
+        _check_outer_shapes(o, x, y, xIdx, yIdx)
         if not self.inplace:
             o = o.copy()
 
-        for b in range(x.shape[0]):
-            for i in range(xIdx.shape[1]):
-                for j in range(yIdx.shape[1]):
-                    o[xIdx[b, i], yIdx[b, j]] += np.outer(x[b, i],
-                                                          y[b, j, :])
+        if _use_numba(o):
+            xIdx, yIdx = _block_indices(xIdx, yIdx, o.shape[0], o.shape[1],
+                                        ('xIdx', 'yIdx'))
+            _numba_kernels()._outer_kernel(o, x, y, xIdx, yIdx,
+                                           o.dtype.type(alpha))
+        else:
+            # All the (batch, xWin, yWin, xSize, ySize) outer products at
+            # once, then one scatter that accumulates repeated
+            # (xIdx, yIdx) pairs.
+            prods = np.einsum('bix,bjy->bijxy', x, y) * alpha
+            _scatter_add_blocks(o, xIdx, yIdx, prods)
+        out_[0][0] = o
+
+    def c_code_cache_version(self):
+        return (1, self.openmp)
+
+    def c_code(self, node, name, inp, out, sub):
+        o, x, y, xIdx, yIdx, alpha = inp
+        z, = out
+        dtype = node.outputs[0].dtype
+        if (dtype not in ('float32', 'float64') or
+                any(v.dtype != dtype for v in node.inputs[:3])):
+            raise utils.MethodNotDefined('%s.c_code'
+                                         % self.__class__.__name__)
+        return sparse_block_outer_c_code(o, x, y, xIdx, yIdx, alpha, z,
+                                         sub['fail'], self.inplace,
+                                         self.openmp)
+
+
+class SparseBlockGemvBias(BaseSparseBlockGemv):
+    """
+    This op computes SparseBlockGemv starting from a bias::
+
+        for b in range(batch_size):
+            for j in range(oIdx.shape[1]):
+                o[b, j, :] = bias[oIdx[b, j]]
+                for i in range(h.shape[1]):
+                    o[b, j, :] += numpy.dot(h[b, i], W[iIdx[b, i], oIdx[b, j]])
+
+    This is the same as ``SparseBlockGemv()(bias.take(oIdx, axis=0), W, h,
+    iIdx, oIdx)``, but the bias blocks are read straight into the
+    accumulators instead of being copied into an intermediate tensor first.
+
+    """
+    __props__ = ()
+
+    def make_node(self, bias, W, h, inputIdx, outputIdx):
+        """
+        Parameters
+        ----------
+        bias : oBlocks, oSize
+            bias vector
+        W : iBlocks, oBlocks, iSize, oSize
+            weight matrix
+        h : batch, iWin, iSize
+            input from lower layer (sparse)
+        inputIdx : batch, iWin
+            indexes of the input blocks
+        outputIdx : batch, oWin
+            indexes of the output blocks
+
+        Returns
+        -------
+        (batch, oWin, oSize)
+            dot(W[i, j], h[i]) + bias[j]
+
+        """
+        bias = theano.tensor.as_tensor_variable(bias)
+        W = theano.tensor.as_tensor_variable(W)
+        h = theano.tensor.as_tensor_variable(h)
+        inputIdx = theano.tensor.as_tensor_variable(inputIdx)
+        outputIdx = theano.tensor.as_tensor_variable(outputIdx)
+
+        if bias.ndim != 2:
+            raise TypeError('The bias must be a 2D tensor')
+        if W.ndim != 4:
+            raise TypeError('The weight matrix W must be a 4D tensor')
+        if h.ndim != 3:
+            raise TypeError('The input h must be a 3D tensor')
+        if inputIdx.ndim != 2:
+            raise TypeError('The input indices inputIdx must be a 2D tensor')
+        if outputIdx.ndim != 2:
+            raise TypeError('The output indices outputIdx must be a 2D tensor')
+
+        assert inputIdx.type.dtype in discrete_dtypes
+        assert outputIdx.type.dtype in discrete_dtypes
+
+        out = theano.tensor.tensor(
+            dtype=bias.dtype,
+            broadcastable=outputIdx.broadcastable + bias.broadcastable[1:])
+        return Apply(self, [bias, W, h, inputIdx, outputIdx], [out])
+
+    def perform(self, node, inp, out_):
+        bias, W, h, iIdx, oIdx = inp
+        o = np.empty(oIdx.shape + bias.shape[1:], dtype=bias.dtype)
+        _sparse_block_gemv(o, W, h, iIdx, oIdx, bias=bias)
         out_[0][0] = o
 
+    def c_code(self, node, name, inp, out, sub):
+        dtype = self._check_c_code(node, node.inputs[:3])
+        bias, W, h, iIdx, oIdx = inp
+        z, = out
+        return sparse_block_gemv_c_code(None, W, h, iIdx, oIdx, z,
+                                        sub['fail'], dtype,
+                                        openmp=self.openmp, bias=bias,
+                                        blas_type=self.blas_type)
+
+    def infer_shape(self, node, input_shapes):
+        bias_shp, _, _, _, oIdx_shp = input_shapes
+        return [(oIdx_shp[0], oIdx_shp[1], bias_shp[1])]
+
+    def grad(self, inputs, grads):
+        bias, W, h, inputIdx, outputIdx = inputs
+        go = grads[0]
+
+        bgrad = theano.tensor.inc_subtensor(
+            bias.zeros_like()[outputIdx.flatten()],
+            go.reshape((-1, go.shape[2])))
+        Wgrad = sparse_block_outer(W.zeros_like(), h, go, inputIdx, outputIdx)
+        hgrad = sparse_block_gemv(h.zeros_like(), W.dimshuffle((1, 0, 3, 2)),
+                                  go, outputIdx, inputIdx)
+        return [bgrad, Wgrad, hgrad,
+                grad_undefined(self, 3, inputIdx,
+                               "grad of inputIdx makes no sense"),
+                grad_undefined(self, 4, outputIdx,
+                               "grad of outputIdx makes no sense")]
+
+
+class SparseBlockGemvMulti(BaseSparseBlockGemv):
+    """
+    This op computes `n` SparseBlockGemv that share their input::
+
+        for k in range(n):
+            if biases[k]:
+                z[k] = SparseBlockGemvBias()(o[k], W[k], h, iIdx, oIdx[k])
+            else:
+                z[k] = SparseBlockGemv()(o[k], W[k], h, iIdx, oIdx[k])
+
+    All the output blocks are computed in the same parallel loop, so h and
+    iIdx are read (and checked) once for all of them. It is introduced by
+    the local_fuse_sparse_block_gemv optimization and has no gradient.
+
+    `biases` has one flag per head (all False by default). The o of a head
+    with a bias is a (oBlocks, oSize) bias, and is never destroyed.
+
+    """
+    __props__ = ('n', 'inplace', 'biases')
+
+    def __init__(self, n, inplace=False, openmp=None, biases=None):
+        super(SparseBlockGemvMulti, self).__init__(openmp=openmp)
+        self.n = n
+        self.inplace = inplace
+        if biases is None:
+            biases = (False,) * n
+        self.biases = tuple(bool(b) for b in biases)
+        if len(self.biases) != n:
+            raise ValueError('Expected %d bias flags' % n)
+        if self.inplace:
+            self.destroy_map = dict((k, [2 + 3 * k]) for k in range(n)
+                                    if not self.biases[k])
+
+    def make_node(self, h, inputIdx, *heads):
+        """
+        Parameters
+        ----------
+        h : batch, iWin, iSize
+            input from lower layer (sparse)
+        inputIdx : batch, iWin
+            indexes of the input blocks
+        heads
+            `n` (o, W, outputIdx) triples, flattened, with the shapes used
+            by SparseBlockGemv (or SparseBlockGemvBias for the heads with a
+            bias).
+
+        """
+        h = theano.tensor.as_tensor_variable(h)
+        inputIdx = theano.tensor.as_tensor_variable(inputIdx)
+        heads = [theano.tensor.as_tensor_variable(v) for v in heads]
+
+        if len(heads) != 3 * self.n:
+            raise TypeError('Expected %d (o, W, outputIdx) triples'
+                            % self.n)
+        if h.ndim != 3:
+            raise TypeError('The input h must be a 3D tensor')
+        if inputIdx.ndim != 2:
+            raise TypeError('The input indices inputIdx must be a 2D tensor')
+        assert inputIdx.type.dtype in discrete_dtypes
+        outputs = []
+        for has_bias, (o, W, outputIdx) in zip(self.biases,
+                                               zip(*[iter(heads)] * 3)):
+            if has_bias and o.ndim != 2:
+                raise TypeError('The bias must be a 2D tensor')
+            if not has_bias and o.ndim != 3:
+                raise TypeError('The output o must be a 3D tensor')
+            if W.ndim != 4:
+                raise TypeError('The weight matrix W must be a 4D tensor')
+            if outputIdx.ndim != 2:
+                raise TypeError('The output indices outputIdx must be a 2D '
+                                'tensor')
+            assert outputIdx.type.dtype in discrete_dtypes
+            if has_bias:
+                outputs.append(theano.tensor.tensor(
+                    dtype=o.dtype,
+                    broadcastable=(outputIdx.broadcastable +
+                                   o.broadcastable[1:])))
+            else:
+                outputs.append(o.type())
+
+        return Apply(self, [h, inputIdx] + heads, outputs)
+
+    def perform(self, node, inp, out_):
+        h, iIdx = inp[:2]
+        for k in range(self.n):
+            o, W, oIdx = inp[2 + 3 * k:5 + 3 * k]
+            if self.biases[k]:
+                bias = o
+                o = np.empty(oIdx.shape + bias.shape[1:], dtype=bias.dtype)
+                _sparse_block_gemv(o, W, h, iIdx, oIdx, bias=bias)
+            else:
+                if not self.inplace:
+                    o = o.copy()
+                _sparse_block_gemv(o, W, h, iIdx, oIdx)
+            out_[k][0] = o
+
+    def c_code(self, node, name, inp, out, sub):
+        variables = [node.inputs[0]] + [v for k, v in
+                                        enumerate(node.inputs[2:])
+                                        if k % 3 != 2]
+        dtype = self._check_c_code(node, variables)
+        h, iIdx = inp[:2]
+        heads = [tuple(inp[2 + 3 * k:5 + 3 * k]) + (out[k],)
+                 for k in range(self.n)]
+        return sparse_block_gemv_multi_c_code(h, iIdx, heads, sub['fail'],
+                                              dtype, self.inplace,
+                                              self.openmp,
+                                              bias=list(self.biases),
+                                              blas_type=self.blas_type)
+
+    def infer_shape(self, node, input_shapes):
+        shapes = []
+        for k in range(self.n):
+            o_shp, _, oIdx_shp = input_shapes[2 + 3 * k:5 + 3 * k]
+            if self.biases[k]:
+                shapes.append((oIdx_shp[0], oIdx_shp[1], o_shp[1]))
+            else:
+                shapes.append(o_shp)
+        return shapes
+
+
+class SparseBlockGemvInt8(OpenMPOp):
+    """
+    This op computes SparseBlockGemv with int8 weights and inputs, for
+    inference::
+
+        for b in range(batch_size):
+            for j in range(oIdx.shape[1]):
+                for i in range(h.shape[1]):
+                    o[b, j, :] += (scales[iIdx[b, i], oIdx[b, j]] * h_scale *
+                                   numpy.dot(h[b, i], W[iIdx[b, i], oIdx[b, j]]))
+
+    where the dot products are exact (accumulated in int32). W has one
+    scale per block and h a single one (see `int8_quantize_blocks` and
+    `int8_quantize`). With AVX512-VNNI, the C code uses vpdpbusd when iSize
+    is a multiple of 4 and oSize a multiple of 16.
+
+    The quantized inputs have no gradient.
+
+    """
+    __props__ = ('inplace',)
+
+    def __init__(self, inplace=False, openmp=None):
+        super(SparseBlockGemvInt8, self).__init__(openmp=openmp)
+        self.inplace = inplace
+        if self.inplace:
+            self.destroy_map = {0: [0]}
+
+    def make_node(self, o, W, scales, h, h_scale, inputIdx, outputIdx):
+        """
+        Parameters
+        ----------
+        o : batch, oWin, oSize
+            output vector
+        W : iBlocks, oBlocks, iSize, oSize
+            int8 weight matrix
+        scales : iBlocks, oBlocks
+            scale of each block of W
+        h : batch, iWin, iSize
+            int8 input from lower layer (sparse)
+        h_scale : scalar
+            scale of h
+        inputIdx : batch, iWin
+            indexes of the input blocks
+        outputIdx : batch, oWin
+            indexes of the output blocks
+
+        Returns
+        -------
+        (batch, oWin, oSize)
+            dot(scales[i, j] * W[i, j], h_scale * h[i]) + o[j]
+
+        """
+        o = theano.tensor.as_tensor_variable(o)
+        W = theano.tensor.as_tensor_variable(W)
+        scales = theano.tensor.as_tensor_variable(scales)
+        h = theano.tensor.as_tensor_variable(h)
+        h_scale = theano.tensor.as_tensor_variable(h_scale)
+        inputIdx = theano.tensor.as_tensor_variable(inputIdx)
+        outputIdx = theano.tensor.as_tensor_variable(outputIdx)
+
+        if o.ndim != 3:
+            raise TypeError('The output o must be a 3D tensor')
+        if W.ndim != 4 or W.dtype != 'int8':
+            raise TypeError('The weight matrix W must be a 4D int8 tensor')
+        if scales.ndim != 2:
+            raise TypeError('The scales must be a 2D tensor')
+        if h.ndim != 3 or h.dtype != 'int8':
+            raise TypeError('The input h must be a 3D int8 tensor')
+        if h_scale.ndim != 0:
+            raise TypeError('h_scale must be a scalar')
+        if inputIdx.ndim != 2:
+            raise TypeError('The input indices inputIdx must be a 2D tensor')
+        if outputIdx.ndim != 2:
+            raise TypeError('The output indices outputIdx must be a 2D tensor')
+
+        assert inputIdx.type.dtype in discrete_dtypes
+        assert outputIdx.type.dtype in discrete_dtypes
+
+        return Apply(self, [o, W, scales, h, h_scale, inputIdx, outputIdx],
+                     [o.type()])
+
+    def perform(self, node, inp, out_):
+        o, W, scales, h, h_scale, iIdx, oIdx = inp
+
+        if not self.inplace:
+            o = o.copy()
+
+        _sparse_block_gemv_int8(o, W, scales, h, h_scale, iIdx, oIdx)
+        out_[0][0] = o
+
+    def infer_shape(self, node, input_shapes):
+        return [input_shapes[0]]
+
+    def grad(self, inputs, grads):
+        return [grads[0]] + [grad_undefined(self, i, inputs[i],
+                                            "SparseBlockGemvInt8 is only "
+                                            "meant for inference")
+                             for i in range(1, 7)]
+
+    def c_support_code(self):
+        return sparse_block_int8_code
+
+    def c_headers(self):
+        return ['<string.h>', '<stdlib.h>'] + super(
+            SparseBlockGemvInt8, self).c_headers()
+
+    def c_code_cache_version(self):
+        return (2, self.openmp)
+
+    def c_code(self, node, name, inp, out, sub):
+        o, W, scales, h, h_scale, iIdx, oIdx = inp
+        z, = out
+        if (node.inputs[0].dtype != 'float32' or
+                node.inputs[2].dtype != 'float32' or
+                node.inputs[4].dtype != 'float32'):
+            raise utils.MethodNotDefined('%s.c_code'
+                                         % self.__class__.__name__)
+        return sparse_block_gemv_int8_c_code(o, W, scales, h, h_scale, iIdx,
+                                             oIdx, z, sub['fail'],
+                                             self.inplace, self.openmp)
+
 
 sparse_block_gemv = SparseBlockGemv(False)
 sparse_block_gemv_inplace = SparseBlockGemv(True)
 sparse_block_outer = SparseBlockOuter(False)
 sparse_block_outer_inplace = SparseBlockOuter(True)
+sparse_block_gemv_int8 = SparseBlockGemvInt8(False)
 
 
-def sparse_block_dot(W, h, inputIdx, b, outputIdx):
+def sparse_block_dot(W, h, inputIdx, b, outputIdx, reorder=False):
     """
     Compute the dot product (plus bias) of the specified pieces of vectors
     and matrices. See SparseBlockGemv to get more information.
@@ -239,6 +1845,12 @@ def sparse_block_dot(W, h, inputIdx, b, outputIdx):
         bias vector
     outputIdx : batch, oWin
         indexes of the output blocks
+    reorder : bool
+        If True, the windows of each example are sorted by block index
+        before the product (and the output is put back in the order of
+        outputIdx). The blocks of W are then read in increasing address
+        order, which helps the cache when the indices are in random order
+        and W doesn't fit in it.
 
     Returns
     -------
@@ -264,5 +1876,12 @@ def sparse_block_dot(W, h, inputIdx, b, outputIdx):
         h = h.dimshuffle('x', 0, 1)
         inputIdx = inputIdx.dimshuffle('x', 0)
         outputIdx = outputIdx.dimshuffle('x', 0)
-    return SparseBlockGemv()(b.take(outputIdx, axis=0), W, h,
-                             inputIdx, outputIdx)
+    if not reorder:
+        return SparseBlockGemvBias()(b, W, h, inputIdx, outputIdx)
+    # The sum over the input blocks doesn't depend on their order.
+    rows = theano.tensor.arange(h.shape[0]).dimshuffle(0, 'x')
+    iOrder = theano.tensor.argsort(inputIdx, axis=1)
+    oOrder = theano.tensor.argsort(outputIdx, axis=1)
+    o = SparseBlockGemvBias()(b, W, h[rows, iOrder], inputIdx[rows, iOrder],
+                              outputIdx[rows, oOrder])
+    return o[rows, theano.tensor.argsort(oOrder, axis=1)]
@@ -0,0 +1,263 @@
+"""
+Numba kernels of the block sparse ops.
+
+This module imports numba (and llvmlite), which is slow, so
+`theano.tensor.nnet.blocksparse` only imports it when a kernel is first
+needed.
+
+Theano forks to run the compiler, and a process that forks after running a
+parallel kernel can hang with numba's TBB threading layer. Unless
+NUMBA_THREADING_LAYER is set, importing this module selects the fork-safe
+workqueue layer (for the whole process). That layer doesn't support
+launching kernels from several threads at once.
+
+"""
+from __future__ import absolute_import, print_function, division
+
+import hashlib
+import importlib.util
+import os
+import sys
+
+import numpy as np
+
+import numba
+from numba.core import cgutils
+from numba.extending import intrinsic
+from llvmlite import ir
+
+from theano import config
+
+if 'NUMBA_THREADING_LAYER' not in os.environ:
+    numba.config.THREADING_LAYER = 'workqueue'
+
+# How many blocks ahead of the current one the gemv kernel prefetches.
+PREFETCH_DISTANCE = 2
+# Tile sizes of the (oWin, iWin) loops of the kernels.
+TILE_OWIN = 8
+TILE_IWIN = 16
+
+# Generated gemv kernels, by (iSize, oSize, unroll).
+_KERNEL_CACHE = {}
+
+
+@intrinsic
+def _prefetch(typingctx, ary, i, j, k):
+    """
+    Prefetch the row ary[i, j, k] into all cache levels.
+
+    """
+    sig = numba.types.void(ary, i, j, k)
+
+    def codegen(context, builder, signature, args):
+        aryty = signature.args[0]
+        arr = context.make_array(aryty)(context, builder, args[0])
+        inds = [context.cast(builder, v, t, numba.types.intp)
+                for v, t in zip(args[1:], signature.args[1:])]
+        inds += [context.get_constant(numba.types.intp, 0)] * (
+            aryty.ndim - len(inds))
+        ptr = cgutils.get_item_pointer(context, builder, aryty, arr, inds)
+        ptr = builder.bitcast(ptr, ir.IntType(8).as_pointer())
+        i32 = ir.IntType(32)
+        fnty = ir.FunctionType(ir.VoidType(), [ptr.type, i32, i32, i32])
+        fn = builder.module.declare_intrinsic('llvm.prefetch',
+                                              [ptr.type], fnty)
+        # read, high locality (T0), data cache
+        builder.call(fn, [ptr, i32(0), i32(3), i32(1)])
+        return context.get_dummy_value()
+    return sig, codegen
+
+
+@numba.njit(inline='always')
+def _axpy_row(acc, hk, w, k, buf, bf16):
+    # acc += hk * w[k], with w holding the bit patterns of bfloat16 weights
+    # if bf16. Both branches are compiled whatever the dtype of w, bf16 is
+    # a run time flag so that the cache of the kernels works.
+    if bf16:
+        # bfloat16 is the upper half of a float32.
+        bits = buf.view(np.uint32)
+        for s in range(acc.shape[0]):
+            bits[s] = np.uint32(w[k, s]) << 16
+        for s in range(acc.shape[0]):
+            acc[s] += hk * buf[s]
+    else:
+        for s in range(acc.shape[0]):
+            acc[s] += hk * w[k, s]
+
+
+@numba.njit(parallel=True, fastmath={'reassoc', 'contract'}, cache=True)
+def _gemv_kernel(o, bias, W, h, iIdx, oIdx, use_bias, bf16):
+    # One output block at a time, accumulated in a local buffer
+    # initialized from o (first filled from bias if use_bias) and
+    # written back once. The (oWin, iWin) iteration is tiled so that the
+    # h blocks of a tile stay in cache while all the output blocks of
+    # the tile use them.
+    oWin = o.shape[1]
+    iWin = h.shape[1]
+    for b in numba.prange(o.shape[0]):
+        acc = np.empty(o.shape[2], dtype=o.dtype)
+        buf = np.empty(o.shape[2], dtype=np.float32)
+        # Before the iWin loop, which may be empty.
+        if use_bias:
+            for j in range(oWin):
+                o[b, j] = bias[oIdx[b, j]]
+        for jb in range(0, oWin, TILE_OWIN):
+            for ib in range(0, iWin, TILE_IWIN):
+                iend = min(ib + TILE_IWIN, iWin)
+                for j in range(jb, min(jb + TILE_OWIN, oWin)):
+                    acc[:] = o[b, j]
+                    for i in range(ib, iend):
+                        # The block index is data dependent, so the
+                        # hardware prefetcher can't guess the next
+                        # block. Only W is prefetched, the indices and h
+                        # are read sequentially.
+                        if i + PREFETCH_DISTANCE < iend:
+                            nxt = iIdx[b, i + PREFETCH_DISTANCE]
+                            for k in range(h.shape[2]):
+                                _prefetch(W, nxt, oIdx[b, j], k)
+                        w = W[iIdx[b, i], oIdx[b, j]]
+                        for k in range(h.shape[2]):
+                            _axpy_row(acc, h[b, i, k], w, k, buf, bf16)
+                    o[b, j] = acc
+
+
+@numba.njit(parallel=True, fastmath={'reassoc', 'contract'}, cache=True)
+def _outer_kernel(o, x, y, xIdx, yIdx, alpha):
+    # Different examples can update the same block of o, so we split
+    # the work over the rows of the blocks instead of over the batch.
+    # The (xWin, yWin) iteration is tiled so that the y blocks of a tile
+    # stay in cache.
+    xWin = xIdx.shape[1]
+    yWin = yIdx.shape[1]
+    for k in numba.prange(x.shape[2]):
+        for b in range(x.shape[0]):
+            for ib in range(0, xWin, TILE_IWIN):
+                for jb in range(0, yWin, TILE_OWIN):
+                    jend = min(jb + TILE_OWIN, yWin)
+                    for i in range(ib, min(ib + TILE_IWIN, xWin)):
+                        xk = alpha * x[b, i, k]
+                        for j in range(jb, jend):
+                            row = o[xIdx[b, i], yIdx[b, j], k]
+                            for s in range(y.shape[2]):
+                                row[s] += xk * y[b, j, s]
+
+
+_SPECIALIZED_GEMV_TEMPLATE = """\
+# Generated by theano.tensor.nnet.blocksparse_numba for %(iSize)dx%(oSize)d
+# blocks.
+import numba
+import numpy as np
+
+from theano.tensor.nnet.blocksparse_numba import _prefetch
+
+PREFETCH_DISTANCE = %(prefetch_distance)d
+TILE_OWIN = %(tile_owin)d
+TILE_IWIN = %(tile_iwin)d
+
+
+@numba.njit(parallel=True, fastmath={'reassoc', 'contract'}, cache=True)
+def kernel(o, bias, W, h, iIdx, oIdx, use_bias, bf16):
+    oWin = o.shape[1]
+    iWin = h.shape[1]
+    for b in numba.prange(o.shape[0]):
+        acc = np.empty(%(oSize)d, dtype=o.dtype)
+        buf = np.empty((%(unroll)d, %(oSize)d), dtype=np.float32)
+        if use_bias:
+            for j in range(oWin):
+                o[b, j] = bias[oIdx[b, j]]
+        for jb in range(0, oWin, TILE_OWIN):
+            for ib in range(0, iWin, TILE_IWIN):
+                iend = min(ib + TILE_IWIN, iWin)
+                for j in range(jb, min(jb + TILE_OWIN, oWin)):
+                    acc[:] = o[b, j]
+                    for i in range(ib, iend):
+                        if i + PREFETCH_DISTANCE < iend:
+                            nxt = iIdx[b, i + PREFETCH_DISTANCE]
+                            for k in range(%(iSize)d):
+                                _prefetch(W, nxt, oIdx[b, j], k)
+                        w = W[iIdx[b, i], oIdx[b, j]]
+                        if bf16:
+%(bf16_body)s
+                        else:
+%(body)s
+                    o[b, j] = acc
+"""
+
+
+def _specialized_gemv_kernel(iSize, oSize, unroll=8):
+    """
+    Return a version of `_gemv_kernel` for (iSize, oSize) blocks.
+
+    The block sizes are constants and the iSize loop is unrolled by
+    `unroll`, so that each element of the accumulator is loaded and stored
+    once per `unroll` rows of the block instead of once per row.
+
+    The source of the kernel is written in the Theano compiledir and
+    imported from there, so that numba can cache the compiled kernel on
+    disk like the other kernels. Loaded kernels are kept in _KERNEL_CACHE.
+
+    """
+    key = (iSize, oSize, unroll)
+    if key not in _KERNEL_CACHE:
+        indent = ' ' * 28
+        body = []
+        bf16_body = []
+        for k0 in range(0, iSize, unroll):
+            rows = range(min(unroll, iSize - k0))
+            for r in rows:
+                body.append(indent + 'h%d = h[b, i, %d]' % (r, k0 + r))
+                body.append(indent + 'w%d = w[%d]' % (r, k0 + r))
+                # bfloat16 is the upper half of a float32.
+                bf16_body.append(indent + 'g%d = h[b, i, %d]' % (r, k0 + r))
+                bf16_body.append(indent + 'bits = buf[%d].view(np.uint32)'
+                                 % r)
+                bf16_body.append(indent + 'for s in range(%d):' % oSize)
+                bf16_body.append(indent + '    bits[s] = np.uint32('
+                                 'w[%d, s]) << 16' % (k0 + r))
+            body.append(indent + 'for s in range(%d):' % oSize)
+            body.append(indent + '    acc[s] += ' +
+                        ' + '.join('h%d * w%d[s]' % (r, r) for r in rows))
+            bf16_body.append(indent + 'for s in range(%d):' % oSize)
+            bf16_body.append(indent + '    acc[s] += ' +
+                             ' + '.join('g%d * buf[%d, s]' % (r, r)
+                                        for r in rows))
+        src = _SPECIALIZED_GEMV_TEMPLATE % dict(
+            iSize=iSize, oSize=oSize, unroll=unroll, body='\n'.join(body),
+            bf16_body='\n'.join(bf16_body),
+            prefetch_distance=PREFETCH_DISTANCE, tile_owin=TILE_OWIN,
+            tile_iwin=TILE_IWIN)
+        _KERNEL_CACHE[key] = _load_generated(
+            src, 'theano_sparse_block_gemv_%dx%d' % (iSize, oSize)).kernel
+    return _KERNEL_CACHE[key]
+
+
+def _load_generated(src, name):
+    """
+    Write `src` in the Theano compiledir, if it isn't there already, and
+    import it as a module (registered in sys.modules, where numba looks for
+    it when it loads a cached kernel).
+
+    The file name contains a hash of the source, and an existing file is
+    never rewritten: numba's disk cache is keyed on its modification time.
+
+    """
+    dirname = os.path.join(config.compiledir, 'blocksparse_numba')
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Created by another process in the meantime.
+            if not os.path.isdir(dirname):
+                raise
+    name = '%s_%s' % (name, hashlib.sha256(src.encode()).hexdigest()[:16])
+    path = os.path.join(dirname, name + '.py')
+    if not os.path.exists(path):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(src)
+        os.replace(tmp, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
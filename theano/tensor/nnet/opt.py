@@ -14,8 +14,10 @@ from theano.tensor.nnet.corr3d import (
     Corr3dMM, Corr3dMM_gradInputs, Corr3dMM_gradWeights)
 from theano.tensor.nnet.blocksparse import (
     SparseBlockGemv,
+    SparseBlockGemvBias,
+    SparseBlockGemvInt8,
+    SparseBlockGemvMulti,
     SparseBlockOuter,
-    sparse_block_gemv_inplace,
     sparse_block_outer_inplace)
 from theano.tensor.nnet.abstract_conv import (AbstractConv2d,
                                               AbstractConv2d_gradWeights,
@@ -32,16 +34,34 @@ from theano.tensor import opt
 from theano.tensor.nnet.conv import conv2d, ConvOp
 
 
-@gof.local_optimizer([SparseBlockGemv], inplace=True)
+@gof.local_optimizer([SparseBlockGemv, SparseBlockGemvMulti,
+                      SparseBlockGemvInt8], inplace=True)
 def local_inplace_sparse_block_gemv(node):
     """
         SparseBlockGemv(inplace=False) -> SparseBlockGemv(inplace=True)
+
+    and the same for SparseBlockGemvMulti and SparseBlockGemvInt8.
     """
-    if isinstance(node.op, SparseBlockGemv) and not node.op.inplace:
-        new_node = sparse_block_gemv_inplace(*node.inputs)
-        copy_stack_trace(node.outputs[0], new_node)
-        return [new_node]
-    return False
+    if (not isinstance(node.op, (SparseBlockGemv, SparseBlockGemvMulti,
+                                 SparseBlockGemvInt8)) or
+            node.op.inplace):
+        return False
+    if isinstance(node.op, SparseBlockGemv):
+        op = SparseBlockGemv(inplace=True, weight_dtype=node.op.weight_dtype,
+                             openmp=node.op.openmp)
+    elif isinstance(node.op, SparseBlockGemvMulti):
+        if all(node.op.biases):
+            # No head has an output to reuse.
+            return False
+        op = SparseBlockGemvMulti(node.op.n, inplace=True,
+                                  openmp=node.op.openmp,
+                                  biases=node.op.biases)
+    else:
+        op = SparseBlockGemvInt8(inplace=True, openmp=node.op.openmp)
+    new_outs = op(*node.inputs, return_list=True)
+    for old, new in zip(node.outputs, new_outs):
+        copy_stack_trace(old, new)
+    return new_outs
 compile.optdb.register('local_inplace_sparse_block_gemv',
                        gof.TopoOptimizer(
                            local_inplace_sparse_block_gemv,
@@ -66,6 +86,57 @@ compile.optdb.register('local_inplace_sparse_block_outer',
                        60, 'fast_run', 'inplace')  # DEBUG
 
 
+def _fusable_sparse_block_gemv(op):
+    # SparseBlockGemvBias has neither inplace nor weight_dtype.
+    return (type(op) in (SparseBlockGemv, SparseBlockGemvBias) and
+            not getattr(op, 'inplace', False) and
+            getattr(op, 'weight_dtype', None) is None)
+
+
+@register_specialize_device
+@local_optimizer([SparseBlockGemv, SparseBlockGemvBias])
+def local_fuse_sparse_block_gemv(node):
+    """
+    SparseBlockGemv(o_k, W_k, h, iIdx, oIdx_k) for k in 1..n
+        -> SparseBlockGemvMulti(n)(h, iIdx, o_1, W_1, oIdx_1, ...)
+
+    SparseBlockGemvBias(b_k, W_k, h, iIdx, oIdx_k) siblings become heads
+    with a bias. Siblings are only fused when none of them depends on
+    another one.
+    """
+    if not _fusable_sparse_block_gemv(node.op):
+        return
+    h, iIdx = node.inputs[2:4]
+    siblings = []
+    for client, i in h.clients:
+        if (client != 'output' and i == 2 and
+                _fusable_sparse_block_gemv(client.op) and
+                client.inputs[3] is iIdx and
+                client.outputs[0].dtype == node.outputs[0].dtype and
+                client not in siblings):
+            siblings.append(client)
+    if len(siblings) < 2:
+        return
+    outputs = set(n.outputs[0] for n in siblings)
+    siblings = [n for n in siblings
+                if not outputs.intersection(gof.graph.ancestors(n.inputs))]
+    if len(siblings) < 2 or node not in siblings:
+        return
+
+    heads = []
+    for n in siblings:
+        o, W, _, _, oIdx = n.inputs
+        heads += [o, W, oIdx]
+    biases = [isinstance(n.op, SparseBlockGemvBias) for n in siblings]
+    new_outs = SparseBlockGemvMulti(len(siblings), biases=biases)(
+        h, iIdx, *heads, return_list=True)
+    replacements = {}
+    for n, new_out in zip(siblings, new_outs):
+        copy_stack_trace(n.outputs[0], new_out)
+        replacements[n.outputs[0]] = new_out
+    return replacements
+
+
 # Conv opts
 @local_optimizer([AbstractConv2d])
 def local_abstractconv_gemm(node):
@@ -2,17 +2,24 @@
     Tests for block sparse dot
 """
 from __future__ import absolute_import, print_function, division
+import os
+import unittest
 
 import numpy as np
 from numpy.random import randn
+from nose.plugins.skip import SkipTest
 
 import theano
 from theano import tensor
 import theano.tests.unittest_tools as utt
 
+from theano.tensor.nnet import blocksparse
 from theano.tensor.nnet.blocksparse import (
     sparse_block_dot, sparse_block_gemv, sparse_block_outer,
-    SparseBlockGemv, SparseBlockOuter)
+    SparseBlockGemv, SparseBlockGemvBias, SparseBlockGemvInt8,
+    SparseBlockGemvMulti,
+    SparseBlockOuter, bf16_pack, bf16_unpack, int8_quantize,
+    int8_quantize_blocks)
 
 
 class BlockSparse_Gemv_and_Outer(utt.InferShapeTester):
@@ -28,14 +35,13 @@ class BlockSparse_Gemv_and_Outer(utt.InferShapeTester):
         self.outer_op = sparse_block_outer
         self.gemv_class = SparseBlockGemv
         self.outer_class = SparseBlockOuter
+        self.dot_class = SparseBlockGemvBias
 
     @staticmethod
-    def gemv_data():
+    def gemv_data(inputSize=6, outputSize=5):
 
         nInputBlock = 8
         nOutputBlock = 7
-        inputSize = 6
-        outputSize = 5
         inputWindowSize = 4
         outputWindowSize = 3
         batchSize = 2
@@ -144,6 +150,27 @@ class BlockSparse_Gemv_and_Outer(utt.InferShapeTester):
 
         utt.assert_allclose(ref_out, th_out)
 
+    def test_sparseblockdot_reorder(self):
+        b = tensor.fmatrix()
+        W = tensor.ftensor4()
+        h = tensor.ftensor3()
+        iIdx = tensor.imatrix()
+        oIdx = tensor.imatrix()
+
+        o = sparse_block_dot(W, h, iIdx, b, oIdx, reorder=True)
+
+        f = theano.function([W, h, iIdx, b, oIdx], o, mode=self.mode)
+
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+
+        th_out = f(W_val, h_val, iIdx_val, b_val, oIdx_val)
+
+        ref_out = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            b_val.take(oIdx_val, axis=0), W_val, h_val, iIdx_val, oIdx_val)
+
+        utt.assert_allclose(ref_out, th_out)
+
     def test_sparseblockgemv(self):
         # Compares the numpy and theano versions of sparseblockgemv.
 
@@ -166,6 +193,30 @@ class BlockSparse_Gemv_and_Outer(utt.InferShapeTester):
 
         utt.assert_allclose(ref_out, th_out)
 
+    def test_sparseblockgemv_duplicates(self):
+        # Windows that use the same blocks several times.
+
+        b = tensor.fmatrix()
+        W = tensor.ftensor4()
+        h = tensor.ftensor3()
+        iIdx = tensor.imatrix()
+        oIdx = tensor.imatrix()
+
+        o = self.gemv_op(b.take(oIdx, axis=0), W, h, iIdx, oIdx)
+
+        f = theano.function([W, h, iIdx, b, oIdx], o, mode=self.mode)
+
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        iIdx_val[:, 1:] = iIdx_val[:, :1]
+        oIdx_val[:, 1:] = oIdx_val[:, :1]
+
+        th_out = f(W_val, h_val, iIdx_val, b_val, oIdx_val)
+        ref_out = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            b_val.take(oIdx_val, axis=0), W_val, h_val, iIdx_val, oIdx_val)
+
+        utt.assert_allclose(ref_out, th_out)
+
     def test_sparseblockgemvF(self):
         # Test the fortan order for W (which can happen in the grad for some
         # graphs).
@@ -194,6 +245,158 @@ class BlockSparse_Gemv_and_Outer(utt.InferShapeTester):
 
         utt.assert_allclose(ref_out, th_out)
 
+    def test_sparseblockgemv_simd(self):
+        # In the C code, float32 blocks whose oSize is a multiple of the
+        # vector width use sparse_block_fma_f32 instead of BLAS (72 is only
+        # a multiple of the AVX2 width).
+        b = tensor.fmatrix()
+        W = tensor.ftensor4()
+        h = tensor.ftensor3()
+        iIdx = tensor.imatrix()
+        oIdx = tensor.imatrix()
+
+        o = self.gemv_op(b.take(oIdx, axis=0), W, h, iIdx, oIdx)
+
+        f = theano.function([W, h, iIdx, b, oIdx], o, mode=self.mode)
+
+        for oSize in (16, 64, 72):
+            W_val, h_val, iIdx_val, b_val, oIdx_val = \
+                BlockSparse_Gemv_and_Outer.gemv_data(outputSize=oSize)
+            # A non-contiguous h, with a stride of 2 elements.
+            h_strided = np.repeat(h_val, 2, axis=2)[:, :, ::2]
+            for h_in in (h_val, h_strided):
+                th_out = f(W_val, h_in, iIdx_val, b_val, oIdx_val)
+                ref_out = BlockSparse_Gemv_and_Outer.gemv_numpy(
+                    b_val.take(oIdx_val, axis=0), W_val, h_val, iIdx_val,
+                    oIdx_val)
+                utt.assert_allclose(ref_out, th_out)
+
+    def test_sparseblockgemv_bf16(self):
+        b = tensor.fmatrix()
+        W = tensor.tensor4(dtype='uint16')
+        h = tensor.ftensor3()
+        iIdx = tensor.imatrix()
+        oIdx = tensor.imatrix()
+
+        o = SparseBlockGemv(weight_dtype='bfloat16')(
+            b.take(oIdx, axis=0), W, h, iIdx, oIdx)
+
+        f = theano.function([W, h, iIdx, b, oIdx], o, mode=self.mode)
+
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        W_bf16 = bf16_pack(W_val)
+
+        th_out = f(W_bf16, h_val, iIdx_val, b_val, oIdx_val)
+        ref_out = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            b_val.take(oIdx_val, axis=0), bf16_unpack(W_bf16), h_val,
+            iIdx_val, oIdx_val)
+
+        utt.assert_allclose(ref_out, th_out)
+
+    def test_sparseblockgemv_int8(self):
+        self.check_sparseblockgemv_int8(6, 5)
+
+    def test_sparseblockgemv_int8_vnni(self):
+        # The C code uses vpdpbusd when iSize % 4 == 0 and oSize % 16 == 0.
+        from theano.gof.cmodule import GCC_compiler
+        march_flags = GCC_compiler.march_flags or []
+        if (not theano.config.cxx or '-mavx512f' not in march_flags or
+                '-mavx512vnni' not in march_flags):
+            raise SkipTest('The CPU does not support AVX512-VNNI')
+        self.check_sparseblockgemv_int8(8, 32)
+
+    def check_sparseblockgemv_int8(self, inputSize, outputSize):
+        o = tensor.ftensor3()
+        W = tensor.tensor4(dtype='int8')
+        scales = tensor.fmatrix()
+        h = tensor.tensor3(dtype='int8')
+        h_scale = tensor.fscalar()
+        iIdx = tensor.imatrix()
+        oIdx = tensor.imatrix()
+
+        out = SparseBlockGemvInt8()(o, W, scales, h, h_scale, iIdx, oIdx)
+
+        f = theano.function([o, W, scales, h, h_scale, iIdx, oIdx], out,
+                            mode=self.mode)
+
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data(inputSize, outputSize)
+        W_i8, scales_val = int8_quantize_blocks(W_val)
+        h_i8, h_scale_val = int8_quantize(h_val)
+        o_val = b_val.take(oIdx_val, axis=0)
+
+        th_out = f(o_val, W_i8, scales_val, h_i8, h_scale_val, iIdx_val,
+                   oIdx_val)
+        ref_out = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            o_val, W_i8 * scales_val[:, :, None, None], h_i8 * h_scale_val,
+            iIdx_val, oIdx_val)
+
+        utt.assert_allclose(ref_out, th_out)
+
+    def test_sparseblockgemv_fused(self):
+        # Two gemv on the same input blocks
+        b = tensor.fmatrix()
+        W = tensor.ftensor4()
+        h = tensor.ftensor3()
+        iIdx = tensor.imatrix()
+        oIdx = tensor.imatrix()
+
+        o1 = self.gemv_op(b.take(oIdx, axis=0), W, h, iIdx, oIdx)
+        o2 = self.gemv_op(b.take(oIdx, axis=0), W[:, ::-1], h, iIdx, oIdx)
+
+        f = theano.function([W, h, iIdx, b, oIdx], [o1, o2], mode=self.mode)
+        if self.gemv_class is SparseBlockGemv:
+            assert any(isinstance(n.op, SparseBlockGemvMulti)
+                       for n in f.maker.fgraph.toposort())
+
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+
+        th_out1, th_out2 = f(W_val, h_val, iIdx_val, b_val, oIdx_val)
+        ref_out1 = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            b_val.take(oIdx_val, axis=0), W_val, h_val, iIdx_val, oIdx_val)
+        ref_out2 = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            b_val.take(oIdx_val, axis=0), W_val[:, ::-1], h_val, iIdx_val,
+            oIdx_val)
+
+        utt.assert_allclose(ref_out1, th_out1)
+        utt.assert_allclose(ref_out2, th_out2)
+
+    def test_sparseblockdot_fused(self):
+        # Two sparse_block_dot and a gemv on the same input blocks
+        b = tensor.fmatrix()
+        W = tensor.ftensor4()
+        h = tensor.ftensor3()
+        iIdx = tensor.imatrix()
+        oIdx = tensor.imatrix()
+
+        o1 = sparse_block_dot(W, h, iIdx, b, oIdx)
+        o2 = sparse_block_dot(W[:, ::-1], h, iIdx, b[::-1], oIdx)
+        o3 = self.gemv_op(b.take(oIdx, axis=0), W, h, iIdx, oIdx)
+
+        f = theano.function([W, h, iIdx, b, oIdx], [o1, o2, o3],
+                            mode=self.mode)
+        if self.dot_class is SparseBlockGemvBias:
+            multi = [n.op for n in f.maker.fgraph.toposort()
+                     if isinstance(n.op, SparseBlockGemvMulti)]
+            assert len(multi) == 1 and sum(multi[0].biases) == 2
+
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+
+        th_out1, th_out2, th_out3 = f(W_val, h_val, iIdx_val, b_val,
+                                      oIdx_val)
+        ref_out1 = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            b_val.take(oIdx_val, axis=0), W_val, h_val, iIdx_val, oIdx_val)
+        ref_out2 = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            b_val[::-1].take(oIdx_val, axis=0), W_val[:, ::-1], h_val,
+            iIdx_val, oIdx_val)
+
+        utt.assert_allclose(ref_out1, th_out1)
+        utt.assert_allclose(ref_out2, th_out2)
+        utt.assert_allclose(ref_out1, th_out3)
+
     def test_sparseblockgemv_grad(self):
 
         W_val, h_val, iIdx_val, b_val, oIdx_val = \
@@ -254,6 +457,32 @@ class BlockSparse_Gemv_and_Outer(utt.InferShapeTester):
         assert h_g.shape == h_val.shape
         assert W_g.shape == W_val.shape
 
+    def test_sparseblockdot_bias_grad(self):
+        # oSize > 1 and repeated output blocks, whose gradients add up.
+        b = tensor.fmatrix()
+        W = tensor.ftensor4()
+        h = tensor.ftensor3()
+        iIdx = tensor.imatrix()
+        oIdx = tensor.imatrix()
+        c = tensor.ftensor3()
+
+        o = sparse_block_dot(W, h, iIdx, b, oIdx)
+        b_g = theano.grad((o * c).sum(), b)
+
+        f = theano.function([W, h, iIdx, b, oIdx, c], b_g, mode=self.mode)
+
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        oIdx_val[:, 1:] = oIdx_val[:, :1]
+        c_val = randn(*(oIdx_val.shape + b_val.shape[1:])).astype('float32')
+
+        ref_out = np.zeros_like(b_val)
+        np.add.at(ref_out, oIdx_val.ravel(),
+                  c_val.reshape(-1, b_val.shape[1]))
+
+        utt.assert_allclose(ref_out, f(W_val, h_val, iIdx_val, b_val,
+                                       oIdx_val, c_val))
+
     def test_sparseblockouter(self):
         o = tensor.ftensor4()
         x = tensor.ftensor3()
@@ -275,6 +504,28 @@ class BlockSparse_Gemv_and_Outer(utt.InferShapeTester):
 
         utt.assert_allclose(ref_out, th_out)
 
+    def test_sparseblockouter_alpha(self):
+        o = tensor.ftensor4()
+        x = tensor.ftensor3()
+        y = tensor.ftensor3()
+        xIdx = tensor.imatrix()
+        yIdx = tensor.imatrix()
+        alpha = tensor.constant(np.asarray(0.5, dtype='float32'))
+
+        out = self.outer_op(o, x, y, xIdx, yIdx, alpha)
+
+        f = theano.function([o, x, y, xIdx, yIdx], out,
+                            on_unused_input="warn", mode=self.mode)
+
+        o_val, x_val, y_val, xIdx_val, yIdx_val = \
+            BlockSparse_Gemv_and_Outer.outer_data()
+
+        th_out = f(o_val, x_val, y_val, xIdx_val, yIdx_val)
+        ref_out = BlockSparse_Gemv_and_Outer.outer_numpy(
+            o_val, 0.5 * x_val, y_val, xIdx_val, yIdx_val)
+
+        utt.assert_allclose(ref_out, th_out)
+
     def test_dot_infershape(self):
         b = tensor.fmatrix()
         W = tensor.ftensor4()
@@ -285,7 +536,7 @@ class BlockSparse_Gemv_and_Outer(utt.InferShapeTester):
         self._compile_and_check([W, h, iIdx, b, oIdx],
                                 [sparse_block_dot(W, h, iIdx, b, oIdx)],
                                 self.gemv_data(),
-                                self.gemv_class)
+                                self.dot_class)
 
     def test_gemv_infershape(self):
         b = tensor.fmatrix()
@@ -311,3 +562,325 @@ class BlockSparse_Gemv_and_Outer(utt.InferShapeTester):
                                 [self.outer_op(o, x, y, xIdx, yIdx)],
                                 self.outer_data(),
                                 self.outer_class)
+
+
+class BlockSparse_perform(unittest.TestCase):
+    # The python implementations, which the default mode doesn't use when
+    # the C code is available. Each test is run with and without the numba
+    # kernels.
+    def setUp(self):
+        utt.seed_rng()
+        self.mode = theano.compile.Mode(linker='py', optimizer='fast_run')
+
+    def for_each_path(self, test):
+        old = blocksparse.numba_available
+        try:
+            for use_numba in (True, False):
+                blocksparse.numba_available = None if use_numba else False
+                test()
+        finally:
+            blocksparse.numba_available = old
+
+    def test_numba_reenable(self):
+        # Disabling numba and enabling it again brings the kernels back.
+        kernels = blocksparse._numba_kernels()
+        if kernels is None:
+            raise SkipTest('numba not available')
+        old = blocksparse.numba_available
+        try:
+            blocksparse.numba_available = False
+            assert blocksparse._numba_kernels() is None
+            blocksparse.numba_available = None
+            assert blocksparse._numba_kernels() is kernels
+        finally:
+            blocksparse.numba_available = old
+
+    def test_numba_threading_layer(self):
+        # TBB can hang when Theano forks after a parallel kernel ran.
+        kernels = blocksparse._numba_kernels()
+        if kernels is None:
+            raise SkipTest('numba not available')
+        if 'NUMBA_THREADING_LAYER' in os.environ:
+            raise SkipTest('NUMBA_THREADING_LAYER is set')
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        blocksparse._sparse_block_gemv(b_val.take(oIdx_val, axis=0), W_val,
+                                       h_val, iIdx_val, oIdx_val)
+        assert kernels.numba.threading_layer() == 'workqueue'
+
+    def gemv_function(self):
+        o = tensor.ftensor3()
+        W = tensor.ftensor4()
+        h = tensor.ftensor3()
+        iIdx = tensor.imatrix()
+        oIdx = tensor.imatrix()
+        return theano.function([o, W, h, iIdx, oIdx],
+                               sparse_block_gemv(o, W, h, iIdx, oIdx),
+                               mode=self.mode)
+
+    def test_gemv(self):
+        f = self.gemv_function()
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        o_val = b_val.take(oIdx_val, axis=0)
+        ref_out = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            o_val.copy(), W_val, h_val, iIdx_val, oIdx_val)
+
+        def test():
+            utt.assert_allclose(ref_out, f(o_val, W_val, h_val, iIdx_val,
+                                           oIdx_val))
+        self.for_each_path(test)
+
+    def test_gemv_bf16(self):
+        o = tensor.ftensor3()
+        W = tensor.tensor4(dtype='uint16')
+        h = tensor.ftensor3()
+        iIdx = tensor.imatrix()
+        oIdx = tensor.imatrix()
+        f = theano.function([o, W, h, iIdx, oIdx],
+                            SparseBlockGemv(weight_dtype='bfloat16')(
+                                o, W, h, iIdx, oIdx),
+                            mode=self.mode)
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        W_bf16 = bf16_pack(W_val)
+        o_val = b_val.take(oIdx_val, axis=0)
+        ref_out = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            o_val.copy(), bf16_unpack(W_bf16), h_val, iIdx_val, oIdx_val)
+
+        def test():
+            utt.assert_allclose(ref_out, f(o_val, W_bf16, h_val, iIdx_val,
+                                           oIdx_val))
+        self.for_each_path(test)
+
+    def test_dot(self):
+        b = tensor.fmatrix()
+        W = tensor.ftensor4()
+        h = tensor.ftensor3()
+        iIdx = tensor.imatrix()
+        oIdx = tensor.imatrix()
+        f = theano.function([W, h, iIdx, b, oIdx],
+                            sparse_block_dot(W, h, iIdx, b, oIdx),
+                            mode=self.mode)
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        ref_out = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            b_val.take(oIdx_val, axis=0), W_val, h_val, iIdx_val, oIdx_val)
+
+        def test():
+            utt.assert_allclose(ref_out, f(W_val, h_val, iIdx_val, b_val,
+                                           oIdx_val))
+        self.for_each_path(test)
+
+    def outer_function(self):
+        o = tensor.ftensor4()
+        x = tensor.ftensor3()
+        y = tensor.ftensor3()
+        xIdx = tensor.imatrix()
+        yIdx = tensor.imatrix()
+        return theano.function([o, x, y, xIdx, yIdx],
+                               sparse_block_outer(o, x, y, xIdx, yIdx),
+                               mode=self.mode)
+
+    def test_outer(self):
+        f = self.outer_function()
+        o_val, x_val, y_val, xIdx_val, yIdx_val = \
+            BlockSparse_Gemv_and_Outer.outer_data()
+        ref_out = BlockSparse_Gemv_and_Outer.outer_numpy(
+            o_val.copy(), x_val, y_val, xIdx_val, yIdx_val)
+
+        def test():
+            utt.assert_allclose(ref_out, f(o_val, x_val, y_val, xIdx_val,
+                                           yIdx_val))
+        self.for_each_path(test)
+
+    def test_outer_negative_indices(self):
+        f = self.outer_function()
+        o_val, x_val, y_val, xIdx_val, yIdx_val = \
+            BlockSparse_Gemv_and_Outer.outer_data()
+        ref_out = BlockSparse_Gemv_and_Outer.outer_numpy(
+            o_val.copy(), x_val, y_val, xIdx_val, yIdx_val)
+        neg_xIdx = xIdx_val - o_val.shape[0]
+        neg_yIdx = yIdx_val - o_val.shape[1]
+
+        def test():
+            for xIdx, yIdx in [(xIdx_val, neg_yIdx), (neg_xIdx, yIdx_val),
+                               (neg_xIdx, neg_yIdx)]:
+                utt.assert_allclose(ref_out, f(o_val, x_val, y_val,
+                                               xIdx, yIdx))
+        self.for_each_path(test)
+
+    def test_outer_out_of_bounds_indices(self):
+        f = self.outer_function()
+        o_val, x_val, y_val, xIdx_val, yIdx_val = \
+            BlockSparse_Gemv_and_Outer.outer_data()
+        xBlocks, yBlocks = o_val.shape[:2]
+
+        def test():
+            # yBlocks would alias the first block of the next row.
+            for i, j in [(xBlocks, 0), (-xBlocks - 1, 0),
+                         (0, yBlocks), (0, -yBlocks - 1)]:
+                bad_xIdx = xIdx_val.copy()
+                bad_yIdx = yIdx_val.copy()
+                bad_xIdx[0, 0] = i
+                bad_yIdx[0, 0] = j
+                self.assertRaises(IndexError, f, o_val, x_val, y_val,
+                                  bad_xIdx, bad_yIdx)
+        self.for_each_path(test)
+
+    def test_outer_shape_mismatch(self):
+        f = self.outer_function()
+        o_val, x_val, y_val, xIdx_val, yIdx_val = \
+            BlockSparse_Gemv_and_Outer.outer_data()
+
+        def test():
+            for x, y, xIdx, yIdx in [
+                    (x_val, np.tile(y_val, 10), xIdx_val, yIdx_val),
+                    (x_val[:, :, :-1], y_val, xIdx_val, yIdx_val),
+                    (x_val, y_val, xIdx_val[:, :-1], yIdx_val),
+                    (x_val, y_val[:1], xIdx_val, yIdx_val[:1])]:
+                self.assertRaises(ValueError, f, o_val, x, y, xIdx, yIdx)
+        self.for_each_path(test)
+
+    def test_scatter_add_blocks_shape(self):
+        # Products of another block shape must not be reshaped into o.
+        o_val, x_val, y_val, xIdx_val, yIdx_val = \
+            BlockSparse_Gemv_and_Outer.outer_data()
+        prods = np.einsum('bix,bjy->bijxy', x_val, np.tile(y_val, 10))
+        self.assertRaises(AssertionError, blocksparse._scatter_add_blocks,
+                          o_val, xIdx_val, yIdx_val, prods)
+
+    def test_gemv_negative_indices(self):
+        f = self.gemv_function()
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        o_val = b_val.take(oIdx_val, axis=0)
+        ref_out = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            o_val.copy(), W_val, h_val, iIdx_val, oIdx_val)
+        neg_iIdx = iIdx_val - W_val.shape[0]
+        neg_oIdx = oIdx_val - W_val.shape[1]
+
+        def test():
+            for iIdx, oIdx in [(iIdx_val, neg_oIdx), (neg_iIdx, oIdx_val),
+                               (neg_iIdx, neg_oIdx)]:
+                utt.assert_allclose(ref_out, f(o_val, W_val, h_val,
+                                               iIdx, oIdx))
+        self.for_each_path(test)
+
+    def test_gemv_out_of_bounds_indices(self):
+        f = self.gemv_function()
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        o_val = b_val.take(oIdx_val, axis=0)
+        iBlocks, oBlocks = W_val.shape[:2]
+
+        def test():
+            for i, j in [(iBlocks, 0), (-iBlocks - 1, 0),
+                         (0, oBlocks), (0, -oBlocks - 1)]:
+                bad_iIdx = iIdx_val.copy()
+                bad_oIdx = oIdx_val.copy()
+                bad_iIdx[0, 0] = i
+                bad_oIdx[0, 0] = j
+                self.assertRaises(IndexError, f, o_val, W_val, h_val,
+                                  bad_iIdx, bad_oIdx)
+        self.for_each_path(test)
+
+    def test_gemv_shape_mismatch(self):
+        f = self.gemv_function()
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        o_val = b_val.take(oIdx_val, axis=0)
+
+        def test():
+            for o, h, iIdx, oIdx in [
+                    (o_val, np.concatenate([h_val, h_val], axis=2),
+                     iIdx_val, oIdx_val),
+                    (o_val[:, :, :-1], h_val, iIdx_val, oIdx_val),
+                    (o_val, h_val, iIdx_val[:, :-1], oIdx_val),
+                    (o_val, h_val, iIdx_val, oIdx_val[:, :-1])]:
+                self.assertRaises(ValueError, f, o, W_val, h, iIdx, oIdx)
+        self.for_each_path(test)
+
+    def test_gemv_dedup(self):
+        # Windows that repeat blocks use _dedup_gemv without numba.
+        f = self.gemv_function()
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        iIdx_val[:, 1:] = iIdx_val[:, :1]
+        oIdx_val[:, 1:] = oIdx_val[:, :1]
+        assert blocksparse._has_many_duplicates(iIdx_val, oIdx_val)
+        o_val = b_val.take(oIdx_val, axis=0)
+        ref_out = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            o_val.copy(), W_val, h_val, iIdx_val, oIdx_val)
+
+        def test():
+            utt.assert_allclose(ref_out, f(o_val, W_val, h_val, iIdx_val,
+                                           oIdx_val))
+        self.for_each_path(test)
+
+    def test_gemv_blas(self):
+        # Without numba, _blas_gemv is used above GATHER_MAX_SIZE.
+        if not blocksparse.have_fblas:
+            raise SkipTest('scipy BLAS not available')
+        f = self.gemv_function()
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        o_val = b_val.take(oIdx_val, axis=0)
+        ref_out = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            o_val.copy(), W_val, h_val, iIdx_val, oIdx_val)
+
+        old = blocksparse.GATHER_MAX_SIZE
+        blocksparse.GATHER_MAX_SIZE = 0
+        try:
+            def test():
+                for W in (W_val, np.asfortranarray(W_val)):
+                    utt.assert_allclose(ref_out, f(o_val, W, h_val,
+                                                   iIdx_val, oIdx_val))
+            self.for_each_path(test)
+        finally:
+            blocksparse.GATHER_MAX_SIZE = old
+
+    def test_gemv_specialized(self):
+        # Small blocks use a kernel generated for their shape, the others
+        # the generic kernel.
+        kernels = blocksparse._numba_kernels()
+        if kernels is None:
+            raise SkipTest('numba not available')
+        f = self.gemv_function()
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+        o_val = b_val.take(oIdx_val, axis=0)
+        ref_out = BlockSparse_Gemv_and_Outer.gemv_numpy(
+            o_val.copy(), W_val, h_val, iIdx_val, oIdx_val)
+        iSize, oSize = W_val.shape[2:]
+
+        old = blocksparse.SPECIALIZE_MAX_SIZE
+        try:
+            for max_size in (0, iSize):
+                blocksparse.SPECIALIZE_MAX_SIZE = max_size
+                specialized = blocksparse._gemv_kernel_for(iSize, oSize)
+                assert (specialized is kernels._gemv_kernel) == (
+                    max_size == 0)
+                utt.assert_allclose(ref_out, f(o_val, W_val, h_val,
+                                               iIdx_val, oIdx_val))
+        finally:
+            blocksparse.SPECIALIZE_MAX_SIZE = old
+
+    def test_dot_empty_input_window(self):
+        # With no input block, the output is the bias.
+        b = tensor.fmatrix()
+        W = tensor.ftensor4()
+        h = tensor.ftensor3()
+        iIdx = tensor.imatrix()
+        oIdx = tensor.imatrix()
+        f = theano.function([W, h, iIdx, b, oIdx],
+                            sparse_block_dot(W, h, iIdx, b, oIdx),
+                            mode=self.mode)
+        W_val, h_val, iIdx_val, b_val, oIdx_val = \
+            BlockSparse_Gemv_and_Outer.gemv_data()
+
+        def test():
+            utt.assert_allclose(b_val.take(oIdx_val, axis=0),
+                                f(W_val, h_val[:, :0], iIdx_val[:, :0],
+                                  b_val, oIdx_val))
+        self.for_each_path(test)